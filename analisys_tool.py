@@ -2,12 +2,26 @@ import os
 import json
 import re
 import tempfile
+import shutil
+import atexit
+import hashlib
+import mmap
+from array import array
 import subprocess
 import logging
 import datetime
+import time
 import sys
 import getopt
+import glob
+import multiprocessing
 import collections
+import collections.abc
+import contextlib
+import itertools
+import resource
+import sqlite3
+import threading
 import xml.etree.ElementTree as ET
 from pathlib import Path
 from collections import deque
@@ -29,12 +43,81 @@ USAGE_VIEW = False
 
 ONLY_C_STYLE = False
 PROCESS_ALTERNATIVES = True
+PREPROCESSOR_FLAGS = ["-E", "-P"]
+EXTRACTOR = "doxygen"   # "regex" - stand-in extractor without gcc and doxygen, used by regression checks
+INCLUDE_ONLY = False    # Build only include graph without extracting structures
+SCHEDULER = "scc"       # "scc" - components of the include graph in topological order, "fifo" - order of updates
+
+# Extraction workspaces. The first available directory is used, None stands for
+# the default temporary directory
+
+SCRATCH_DIRS = ("/dev/shm", None)
+
+# Extraction cache. Structure of a file is reused while the file and all headers
+# read by the preprocessor are unchanged and the same include set is used.
+# Identical preprocessed sources share one structure
+
+EXTRACTION_CACHE_DIR = ".cjake_cache"  # None to disable
+
+# Source inventory
+
+INVENTORY_ROLES = ("Dirs", "Search_dirs", "Edge_search_dirs")
+INVENTORY_CACHE_FILE = ".cjake_inventory.json"  # Directory listings are reused if mtimes are not changed. None to disable
 
 # Logging
 
 LOG_TO_STDOUT = True
 LOG_NAME_FORMAT = "CJake log %H-%M-%S %d-%m-%Y.log"
-LOG_LEVEL = logging.DEBUG
+LOG_LEVEL = logging.INFO
+
+# Structured trace. Events are written as JSON lines only for enabled categories:
+# visit - node is processed, requeue - node is added to the processing queue,
+# keywords - keywords found in the node, miss - name or file can't be resolved
+
+TRACE_FILE = None       # Disabled if None
+TRACE_CATEGORIES = ("visit", "requeue", "keywords", "miss")
+TRACE_SAMPLE_EVERY = 1  # Write only every N-th event of each category
+
+# Live progress. Nodes discovered, extracted and pending, queue depth, current
+# file, ETA of the phase and the slowest running subprocess are printed to STDERR
+# and exported as Prometheus textfile every PROGRESS_INTERVAL seconds
+
+SHOW_PROGRESS = False
+PROGRESS_INTERVAL = 10  # Seconds
+METRICS_FILE = None     # Rewritten atomically, e.g. for node_exporter textfile collector. Disabled if None
+
+# Memory bounded mode. Structures are spilled to SQLite database and loaded on demand
+
+MEMORY_BOUNDED = False
+MEMORY_LIMIT_MB = 2048  # Budget for serialized size of structures kept in memory
+SPILL_DB_PATH = None    # Temporary database is used if not set
+
+# Provenance. Chains of requirements from root files are printed for these
+# (module, entity) pairs, e.g. ("classfile/classLoader.hpp", "compile_the_world_in")
+
+WHY_QUERIES = []
+WHY_SNAPSHOT = None     # Answer the queries from this snapshot (partial result) without analysis
+
+# Per phase wall time and peak RSS are saved to this file as JSON
+
+PHASE_STATS_FILE = None
+
+# Diff mode. The result of the analysis is saved as a snapshot and compared with
+# a previous one, unchanged files are taken from the extraction cache
+
+SNAPSHOT_FILE = None    # Save snapshot of the analysis to this file
+DIFF_SNAPSHOTS = []     # [old] to compare with this analysis or [old, new] to compare snapshots only
+
+# Sharded analysis
+
+SHARD_INDEX = None      # Process only a shard of root files if set
+SHARD_COUNT = 1
+LOCAL_SHARDS = 0        # Run this number of shards as local processes and merge them
+MERGE_SHARDS = False    # Merge partial results from SHARD_OUTPUT_DIR
+SHARD_OUTPUT_DIR = "shards"     # Can be a directory shared between hosts
+SHARD_NAME_FORMAT = "shard-{}-of-{}.json"
+SHARD_GLOB = "shard-*-of-*.json"
+PARTIAL_FORMAT_VERSION = 1
 
 # Arguments parsing
 
@@ -42,7 +125,7 @@ PARSE_ARGUMENTS = True
 
 ### Imported code
 ### from http://code.activestate.com/recipes/576694/
-class OrderedSet(collections.MutableSet):
+class OrderedSet(collections.abc.MutableSet):
 
     def __init__(self, iterable=None):
         self.end = end = [] 
@@ -102,8 +185,698 @@ class OrderedSet(collections.MutableSet):
 
 ### End of imported code
 
+def peak_rss_mb():
+    # ru_maxrss is measured in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class StructureStore:
+    # Keeps structures of the nodes in SQLite database. Recently used structures
+    # are kept in memory (resident) while their serialized size fits the budget,
+    # the least recently used ones are evicted. Keyword tables, patterns and
+    # line offsets built for a node are charged to the budget too and dropped
+    # with its structure. RSS is only reported because freed memory is rarely
+    # returned to the OS
+    def __init__(self, db_path, memory_limit_mb):
+        self.tempdir = None
+        if not db_path:
+            self.tempdir = tempfile.TemporaryDirectory()
+            db_path = os.path.join(self.tempdir.name, "structures.db")
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS structures (node_id INTEGER PRIMARY KEY, data TEXT)")
+        self.connection.execute("DELETE FROM structures")
+        self.memory_limit_mb = memory_limit_mb
+        self.budget = memory_limit_mb * 1024 * 1024
+        self.resident = collections.OrderedDict()   # node_id -> [node, structure, size, derived size], LRU first
+        self.resident_size = 0
+        self.peak_resident_size = 0
+        self.spills = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def save(self, node, structure):
+        self.connection.execute("INSERT OR REPLACE INTO structures VALUES (?, ?)", \
+                                (node.node_id, json.dumps(structure)))
+        entry = self.resident.get(node.node_id)
+        if entry and entry[1] is not None:
+            self.resident_size -= entry[2]
+            entry[1], entry[2] = None, 0
+            self._forget_empty(node.node_id)
+        self.spills += 1
+
+    def load(self, node):
+        entry = self.resident.get(node.node_id)
+        if entry and entry[1] is not None:
+            self.resident.move_to_end(node.node_id)
+            return entry[1]
+        data = self.connection.execute("SELECT data FROM structures WHERE node_id = ?", \
+                                       (node.node_id,)).fetchone()[0]
+        structure = json.loads(data)
+        self.loads += 1
+        entry = self.resident.setdefault(node.node_id, [node, None, 0, 0])
+        entry[1], entry[2] = structure, len(data)
+        self.resident_size += len(data)
+        self._touch(node.node_id)
+        return structure
+
+    def charge(self, node, size):
+        # Sets the size of keyword tables, patterns and line offsets of the node.
+        # Only growth touches the node, released memory never evicts anything
+        entry = self.resident.get(node.node_id)
+        if not entry:
+            if not size:
+                return
+            entry = self.resident[node.node_id] = [node, None, 0, 0]
+        growth = size - entry[3]
+        self.resident_size += growth
+        entry[3] = size
+        if growth > 0:
+            self._touch(node.node_id)
+        else:
+            self._forget_empty(node.node_id)
+
+    def _touch(self, node_id):
+        self.resident.move_to_end(node_id)
+        self.peak_resident_size = max(self.peak_resident_size, self.resident_size)
+        self._evict(node_id)
+
+    def _forget_empty(self, node_id):
+        entry = self.resident[node_id]
+        if entry[1] is None and not entry[3]:
+            del self.resident[node_id]
+
+    def _evict(self, keep_id):
+        # The node which is being used is kept even if it exceeds the budget alone
+        while self.resident_size > self.budget and len(self.resident) > 1:
+            node_id = next(iter(self.resident))
+            if node_id == keep_id:
+                break
+            node, structure, size, derived_size = self.resident.pop(node_id)
+            self.resident_size -= size + derived_size
+            self.evictions += 1
+            node.drop_derived()
+            # Cached keyword tables of the parents keep references to the structure too
+            for parent in node.parents:
+                parent.invalidate_matchers()
+
+    def report(self):
+        print("Peak RSS: {:.1f} MB, resident structures and keyword tables {:.1f} MB at peak (limit {} MB), "
+              "{} structures spilled, {} loaded from disk, {} evicted".format(\
+            peak_rss_mb(), self.peak_resident_size / (1024 * 1024), self.memory_limit_mb, \
+            self.spills, self.loads, self.evictions))
+
+    def close(self):
+        self.connection.close()
+        if self.tempdir:
+            self.tempdir.cleanup()
+
+STRUCTURE_STORE = None  # Set in memory bounded mode
+
+class Tracer:
+    # Callers check enabled() before building an event, so nothing is
+    # formatted for disabled categories and nothing at all if TRACER is None
+    def __init__(self, path, categories, sample_every):
+        self.file = open(path, "w")
+        self.categories = frozenset(categories)
+        self.sample_every = sample_every
+        self.counters = collections.Counter()
+        self.start = time.monotonic()
+
+    def enabled(self, category):
+        if not category in self.categories:
+            return False
+        self.counters[category] += 1
+        return self.sample_every <= 1 or self.counters[category] % self.sample_every == 1
+
+    def event(self, category, **fields):
+        fields["cat"] = category
+        fields["t"] = round(time.monotonic() - self.start, 6)
+        self.file.write(json.dumps(fields) + "\n")
+
+    def close(self):
+        self.file.close()
+
+TRACER = None   # Set if TRACE_FILE is given
+
+class Progress:
+    # The analysis only updates counters, a background thread prints them and
+    # rewrites the metrics file. ETA of a phase is estimated from the rate of
+    # processed items and the number of pending ones
+    def __init__(self, interval, show, metrics_path, labels=None):
+        self.interval = interval
+        self.show = show
+        self.metrics_path = metrics_path
+        self.labels = labels or {}
+        self.start = time.monotonic()
+        self.phase = None
+        self.phase_start = self.start
+        self.phase_seconds = collections.OrderedDict()  # Finished phases
+        self.done = 0           # Items processed in the current phase
+        self.discovered = 0
+        self.extracted = 0
+        self.pending = 0
+        self.queue = 0
+        self.visits = 0
+        self.current_file = None
+        self.subprocesses = {}  # key -> (command, file_path, start)
+        self._keys = itertools.count()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def start_phase(self, name):
+        with self.lock:
+            self.phase = name
+            self.phase_start = time.monotonic()
+            self.done = self.pending = self.queue = 0
+
+    def end_phase(self):
+        with self.lock:
+            self.phase_seconds[self.phase] = self.phase_seconds.get(self.phase, 0) + \
+                time.monotonic() - self.phase_start
+            self.phase = None
+
+    def step(self, current_file, pending, queue=None):
+        self.done += 1
+        self.current_file = current_file
+        self.pending = pending
+        self.queue = pending if queue is None else queue
+
+    def subprocess_started(self, command, file_path):
+        key = next(self._keys)
+        with self.lock:
+            self.subprocesses[key] = (os.path.basename(command[0]), file_path, time.monotonic())
+        return key
+
+    def subprocess_finished(self, key):
+        with self.lock:
+            del self.subprocesses[key]
+
+    def eta(self):
+        if not self.done or not self.pending:
+            return None
+        return (time.monotonic() - self.phase_start) / self.done * self.pending
+
+    def slowest_subprocess(self):
+        with self.lock:
+            if not self.subprocesses:
+                return None
+            command, file_path, start = min(self.subprocesses.values(), key=lambda s: s[2])
+        return command, file_path, time.monotonic() - start
+
+    def summary(self):
+        line = "[{} {:.1f}s] {} discovered, {} extracted, {} pending, queue {}, {} visits".format(\
+            self.phase or "idle", time.monotonic() - self.phase_start, \
+            self.discovered, self.extracted, self.pending, self.queue, self.visits)
+        eta = self.eta()
+        if eta is not None:
+            line += ", ETA {:.0f}s".format(eta)
+        if self.current_file:
+            line += ", current '{}'".format(self.current_file)
+        slowest = self.slowest_subprocess()
+        if slowest:
+            line += ", slowest {} of '{}' running {:.1f}s".format(*slowest)
+        return line
+
+    def _metric(self, lines, name, kind, help_str, samples):
+        # samples: [(labels, value), ..]
+        lines.append("# HELP {} {}".format(name, help_str))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in samples:
+            labels = dict(self.labels, **labels)
+            label_str = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) \
+                                 for k, v in sorted(labels.items()))
+            lines.append("{}{} {}".format(name, "{" + label_str + "}" if label_str else "", value))
+
+    def metrics(self):
+        now = time.monotonic()
+        with self.lock:
+            phase_seconds = collections.OrderedDict(self.phase_seconds)
+            phase = self.phase
+            if phase:
+                phase_seconds[phase] = phase_seconds.get(phase, 0) + now - self.phase_start
+        slowest = self.slowest_subprocess()
+        eta = self.eta()
+
+        lines = []
+        self._metric(lines, "cjake_elapsed_seconds", "gauge", "Wall time since the start of the analysis", \
+                     [({}, round(now - self.start, 3))])
+        self._metric(lines, "cjake_phase_seconds", "gauge", "Wall time spent in the phase", \
+                     [({"phase" : name}, round(seconds, 3)) for name, seconds in phase_seconds.items()])
+        self._metric(lines, "cjake_phase_running", "gauge", "1 for the running phase", \
+                     [({"phase" : name}, int(name == phase)) for name in phase_seconds])
+        self._metric(lines, "cjake_phase_items_done", "gauge", "Items processed in the running phase", \
+                     [({}, self.done)])
+        self._metric(lines, "cjake_phase_eta_seconds", "gauge", "Estimated time left in the running phase, -1 if unknown", \
+                     [({}, -1 if eta is None else round(eta, 3))])
+        self._metric(lines, "cjake_nodes_discovered", "gauge", "Nodes of the include graph", [({}, self.discovered)])
+        self._metric(lines, "cjake_nodes_extracted", "gauge", "Nodes with extracted structures", [({}, self.extracted)])
+        self._metric(lines, "cjake_nodes_pending", "gauge", "Nodes waiting to be processed in the running phase", \
+                     [({}, self.pending)])
+        self._metric(lines, "cjake_queue_depth", "gauge", "Depth of the current processing queue", [({}, self.queue)])
+        self._metric(lines, "cjake_node_visits_total", "counter", "Nodes processed by the propagation", \
+                     [({}, self.visits)])
+        self._metric(lines, "cjake_subprocesses_running", "gauge", "Running extraction subprocesses", \
+                     [({}, len(self.subprocesses))])
+        self._metric(lines, "cjake_slowest_subprocess_seconds", "gauge", "Run time of the oldest running subprocess", \
+                     [({"command" : slowest[0]}, round(slowest[2], 3))] if slowest else [])
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self):
+        # Readers never see partially written file
+        tmp_path = self.metrics_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.metrics())
+        os.replace(tmp_path, self.metrics_path)
+
+    def report(self):
+        if self.show:
+            sys.stderr.write(self.summary() + "\n")
+        if self.metrics_path:
+            self.write_metrics()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.report()
+            except OSError as e:
+                logging.warning("Progress report failed: {}".format(e))
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.metrics_path:   # Final state of the analysis
+            self.write_metrics()
+
+PROGRESS = None # Set if progress is shown or exported
+
+@contextlib.contextmanager
+def tracked_subprocess(command, file_path):
+    # Running subprocess is shown in the progress
+    key = PROGRESS.subprocess_started(command, file_path) if PROGRESS else None
+    try:
+        yield
+    finally:
+        if key is not None:
+            PROGRESS.subprocess_finished(key)
+
+def start_progress(suffix="", labels=None):
+    if not SHOW_PROGRESS and not METRICS_FILE:
+        return None
+    metrics_path = None
+    if METRICS_FILE:    # Suffix goes before the extension, textfile collector reads only *.prom
+        root, extension = os.path.splitext(METRICS_FILE)
+        metrics_path = root + suffix + extension
+    return Progress(PROGRESS_INTERVAL, SHOW_PROGRESS, metrics_path, labels)
+
+class ScratchPool:
+    # Long-lived workspaces for extraction. Workspaces are created once
+    # (in tmpfs if available) and only their content is removed after use
+    def __init__(self, scratch_dirs):
+        self.scratch_dirs = scratch_dirs
+        self.base = None
+        self.free = []
+        self.pid = None
+
+    def _base_dir(self):
+        if self.pid != os.getpid():
+            # Forked shard processes must not share workspaces with the parent
+            self.pid = os.getpid()
+            self.base = None
+            self.free = []
+        if not self.base:
+            for scratch_dir in self.scratch_dirs:
+                if scratch_dir is None or (os.path.isdir(scratch_dir) and os.access(scratch_dir, os.W_OK)):
+                    self.base = tempfile.mkdtemp(prefix="cjake-", dir=scratch_dir)
+                    break
+        return self.base
+
+    def acquire(self):
+        base = self._base_dir()
+        if self.free:
+            return self.free.pop()
+        return tempfile.mkdtemp(dir=base)
+
+    def release(self, workspace):
+        with os.scandir(workspace) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+        self.free.append(workspace)
+
+    def close(self):
+        if self.base and self.pid == os.getpid():
+            shutil.rmtree(self.base, ignore_errors=True)
+            self.base = None
+
+class ProvenanceIndex:
+    # Records why entities are required: (node, entity) <- (requiring node,
+    # requiring entity, line). Requiring entity is None if the line belongs
+    # to a root file, which is scanned completely
+    def __init__(self):
+        self.sources = {}   # (node_id, entity) -> {(node_id, entity) : line}
+        self.nodes = {}     # node_id -> node
+
+    def edges(self):
+        # [(node, entity, source node, source entity, line), ..]
+        for (node_id, entity), sources in self.sources.items():
+            for (source_id, source_entity), line in sources.items():
+                yield self.nodes[node_id], entity, self.nodes[source_id], source_entity, line
+
+    def add(self, node, entity, source_node, source_entity, line):
+        self.nodes[node.node_id] = node
+        self.nodes[source_node.node_id] = source_node
+        sources = self.sources.setdefault((node.node_id, entity), {})
+        sources.setdefault((source_node.node_id, source_entity), line)
+
+    def why(self, node, entity):
+        # Shortest chain of requirements from a root file to the entity.
+        # Returns [(node, entity, line), ..] starting from the root, where line
+        # is the line of the node referring to the next entity in the chain
+        target = (node.node_id, entity)
+        previous = {target : None}
+        queue = deque([target])
+        while queue:
+            current = queue.popleft()
+            for source, line in self.sources.get(current, {}).items():
+                if source in previous:
+                    continue
+                previous[source] = (current, line)
+                source_node = self.nodes[source[0]]
+                if source[1] is None and source_node.root:
+                    return self._chain(source, previous)
+                queue.append(source)
+        return None
+
+    def _chain(self, source, previous):
+        chain = []
+        current = source
+        while current:
+            step = previous[current]
+            if step:
+                chain.append((self.nodes[current[0]], current[1], step[1]))
+                current = step[0]
+            else:
+                chain.append((self.nodes[current[0]], current[1], None))
+                current = None
+        return chain
+
+PROVENANCE_INDEX = None # Set if provenance queries are given
+
+SCRATCH_POOL = ScratchPool(SCRATCH_DIRS)
+atexit.register(SCRATCH_POOL.close)
+
+class ExtractionCache:
+    # units/<key>.json - headers read while preprocessing a file with given
+    #                    includes (path, mtime, size) and digest of the result
+    # structures/<digest>.json - structure extracted from preprocessed source
+    # Both are keyed by the digest of Doxyfile too, structures depend on it.
+    # Paths inside the source tree are stored relative to its root, so the
+    # same sources checked out at another place share the cache
+    def __init__(self, cache_dir, doxyfile_path):
+        self.config_digest = file_digest(doxyfile_path) if os.path.exists(doxyfile_path) else ""
+        self.tree_root = None
+        self.tree_prefixes = []
+        self.digests = {}   # (path, mtime, size) -> digest of the content
+        self.units_dir = os.path.join(cache_dir, "units")
+        self.structures_dir = os.path.join(cache_dir, "structures")
+        os.makedirs(self.units_dir, exist_ok=True)
+        os.makedirs(self.structures_dir, exist_ok=True)
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+
+    def set_tree_root(self, dirs):
+        # Root of the source tree is the common parent of its directories
+        dirs = [os.path.abspath(d) for d in dirs]
+        if not dirs:
+            return
+        self.tree_root = os.path.commonpath(dirs)
+        # Longer prefixes first, gcc prints paths as they are given
+        self.tree_prefixes = sorted({self.tree_root + os.sep, os.path.relpath(self.tree_root) + os.sep}, \
+                                    key=len, reverse=True)
+
+    def _key_path(self, path):
+        path = os.path.abspath(path)
+        if self.tree_root and path.startswith(self.tree_root + os.sep):
+            return "<tree>/" + os.path.relpath(path, self.tree_root)
+        return path
+
+    def _real_path(self, key_path):
+        if key_path.startswith("<tree>/"):
+            return os.path.join(self.tree_root, key_path[len("<tree>/"):])
+        return key_path
+
+    def unit_key(self, file_path, includes):
+        # Macro context of the file is defined by the include set
+        context = json.dumps([self._key_path(file_path), list(includes), PREPROCESSOR_FLAGS, self.config_digest])
+        return hashlib.sha1(context.encode()).hexdigest()
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, data):
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _content_digest(self, path, stat):
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        if not key in self.digests:
+            self.digests[key] = file_digest(path)
+        return self.digests[key]
+
+    def _stamp(self, path):
+        stat = os.stat(path)
+        return [self._key_path(path), stat.st_mtime_ns, stat.st_size, self._content_digest(path, stat)]
+
+    def _is_unchanged(self, stamp):
+        # Content is compared only if mtime differs, e.g. in another checkout
+        key_path, mtime, size, digest = stamp
+        path = self._real_path(key_path)
+        stat = os.stat(path)
+        if stat.st_size != size:
+            return False
+        return stat.st_mtime_ns == mtime or self._content_digest(path, stat) == digest
+
+    def lookup(self, file_path, includes):
+        unit = self._read(os.path.join(self.units_dir, self.unit_key(file_path, includes) + ".json"))
+        if not unit:
+            return None
+        for stamp in unit["deps"]:
+            try:
+                if len(stamp) != 4 or not self._is_unchanged(stamp):
+                    return None
+            except OSError:
+                return None
+        structure = self.lookup_digest(unit["digest"])
+        if structure is not None:
+            self.hits += 1
+        return structure
+
+    def preprocessed_digest(self, path):
+        # Linemarkers contain paths of the files, the tree root is removed from them
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for line in f:
+                if line.startswith(b"#"):
+                    for prefix in self.tree_prefixes:
+                        line = line.replace(prefix.encode(), b"<tree>/")
+                digest.update(line)
+        return digest.hexdigest()
+
+    def _structure_path(self, digest):
+        key = hashlib.sha1((self.config_digest + digest).encode()).hexdigest()
+        return os.path.join(self.structures_dir, key + ".json")
+
+    def lookup_digest(self, digest):
+        return self._read(self._structure_path(digest))
+
+    def store(self, file_path, includes, dep_paths, digest, structure=None):
+        try:
+            deps = [self._stamp(path) for path in dep_paths]
+        except OSError:
+            return
+        if structure is not None:
+            self._write(self._structure_path(digest), structure)
+        self._write(os.path.join(self.units_dir, self.unit_key(file_path, includes) + ".json"), \
+                    {"deps" : deps, "digest" : digest})
+
+def read_make_dependencies(path):
+    # Parses dependency file written by gcc -MD
+    with open(path) as f:
+        content = f.read().replace("\\\n", " ")
+    deps = content.split(": ", 1)[1] if ": " in content else ""
+    return [dep.replace("\\ ", " ") for dep in re.split(r"(?<!\\)\s+", deps.strip()) if dep]
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+EXTRACTION_CACHE = None # Set if EXTRACTION_CACHE_DIR is given
+
+def strongly_connected_components(start_nodes):
+    # Iterative Tarjan's algorithm over dependencies of the nodes reachable from
+    # start_nodes. Components are returned in reverse topological order, so
+    # dependencies always come before the nodes including them
+    index = {}      # node_id -> visiting order
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    for start_node in start_nodes:
+        if start_node.node_id in index:
+            continue
+        index[start_node.node_id] = lowlink[start_node.node_id] = len(index)
+        stack.append(start_node)
+        on_stack.add(start_node.node_id)
+        work = [(start_node, iter(start_node.dependencies))]
+
+        while work:
+            node, deps = work[-1]
+            descended = False
+            for dep in deps:
+                if not dep.node_id in index:
+                    index[dep.node_id] = lowlink[dep.node_id] = len(index)
+                    stack.append(dep)
+                    on_stack.add(dep.node_id)
+                    work.append((dep, iter(dep.dependencies)))
+                    descended = True
+                    break
+                elif dep.node_id in on_stack:
+                    lowlink[node.node_id] = min(lowlink[node.node_id], index[dep.node_id])
+            if descended:
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent.node_id] = min(lowlink[parent.node_id], lowlink[node.node_id])
+            if lowlink[node.node_id] == index[node.node_id]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member.node_id)
+                    component.append(member)
+                    if member is node:
+                        break
+                components.append(component)
+
+    return components
+
+def iterate_bits(mask):
+    # Indices of the set bits
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+REGEX_FUNCTION = re.compile(r"^[A-Za-z_][\w\s\*&:<>,]*?\b(\w+)\s*\([^;]*\)\s*(const\s*)?(\{.*)?$")
+REGEX_PROTOTYPE = re.compile(r"^[A-Za-z_][\w\s\*&:<>,]*?\b(\w+)\s*\([^;]*\)\s*(const\s*)?;")
+REGEX_CLASS = re.compile(r"^(?:typedef\s+)?(?:struct|class|union|enum)\s+(\w+)")
+REGEX_TYPEDEF = re.compile(r"^typedef\b.*?\b(\w+)\s*;")
+REGEX_VARIABLE = re.compile(r"^(?:(?:static|extern|const)\s+)*[A-Za-z_]\w*[\s\*]+(\w+)\s*(?:\[[^\]]*\])?\s*(?:=[^;]*)?;")
+
+def extract_structure_with_regex(file_path):
+    # Stand-in for gcc and doxygen: recognizes declarations written one per
+    # line at file level and in class bodies, which is enough for small
+    # fixture trees
+    file_structure = {
+        "class":[],
+        "function":[],
+        "variable":[],
+        "typedef":[]
+    }
+    depth = 0
+    declaration_depths = [0]    # Depths of file level and class bodies
+    current_function = None     # Function which body is being read
+    function_depth = None
+    with open(file_path, errors="replace") as f:
+        for str_idx, content in enumerate(f):
+            line = content.split("//")[0].strip()
+            if not line or line.startswith("#"):
+                continue
+            if current_function is None and depth == declaration_depths[-1]:
+                kind = None
+                match = REGEX_CLASS.match(line)
+                if match:
+                    kind = "class"
+                    if "{" in line or not line.endswith(";"):
+                        declaration_depths.append(depth + 1)
+                elif REGEX_TYPEDEF.match(line):
+                    kind, match = "typedef", REGEX_TYPEDEF.match(line)
+                elif REGEX_PROTOTYPE.match(line):
+                    kind, match = "function", REGEX_PROTOTYPE.match(line)
+                elif REGEX_FUNCTION.match(line):
+                    current_function = {
+                        "name" : REGEX_FUNCTION.match(line).group(1),
+                        "start_line" : str_idx + 1,
+                        "end_line" : None,
+                    }
+                    function_depth = depth
+                    file_structure["function"].append(current_function)
+                elif REGEX_VARIABLE.match(line):
+                    kind, match = "variable", REGEX_VARIABLE.match(line)
+                if kind:
+                    file_structure[kind].append({
+                        "name" : match.group(1),
+                        "start_line" : None,
+                        "end_line" : None,
+                    })
+            depth += line.count("{") - line.count("}")
+            if current_function and depth <= function_depth and "}" in line:
+                current_function["end_line"] = str_idx + 1
+                current_function = None
+            while len(declaration_depths) > 1 and depth < declaration_depths[-1]:
+                declaration_depths.pop()    # Class body is closed
+    return file_structure
+
+class LineIndex:
+    # Offsets of the lines in a memory-mapped file, so that any range of lines
+    # is sliced directly instead of reading the file from the beginning.
+    # Offsets can be reused while the file is not changed
+    def __init__(self, file_path, offsets=None):
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        if offsets is None or offsets[-1] != size:
+            offsets = array("Q", [0])
+            position = self.buffer.find(b"\n")
+            while position != -1:
+                offsets.append(position + 1)
+                position = self.buffer.find(b"\n", position + 1)
+            if offsets[-1] != size: # Last line without a line break
+                offsets.append(size)
+        self.offsets = offsets  # Start of every line and the end of the file
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lines(self, start_line, end_line):
+        # Lines [start_line, end_line] (numbered from 1) with their numbers
+        for idx in range(max(start_line, 1) - 1, min(end_line, len(self))):
+            yield idx + 1, self.buffer[self.offsets[idx]:self.offsets[idx + 1]].decode(errors="replace")
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
 class DependencyNode:
+    _ids = itertools.count()
+
     def __init__(self, file_path, name, parent, preprocessing_includes):
+        self.node_id = next(DependencyNode._ids)
         self.file_path = file_path
         self.name = name
         self.dependencies = []
@@ -111,7 +884,10 @@ class DependencyNode:
         if parent:
             self.add_parent(parent)
         # self.implementation = None
-        self.structure = None
+        self._structure = None
+        self.spilled = False
+        self._matchers = None   # (keywords_table, file_functions, pattern, local_pattern)
+        self._line_offsets = None   # Offsets of the lines in the file, see LineIndex
         self.required_functions = {}    # name -> [{name, start_line, end_line}, ..]
                                         # Dictionary is needed to keep uniqueness of function entities
         self.root = False
@@ -120,6 +896,27 @@ class DependencyNode:
         # Extract structure
         self.extract_functions(preprocessing_includes)
 
+    @property
+    def structure(self):
+        if self.spilled:
+            return STRUCTURE_STORE.load(self)
+        return self._structure
+
+    @structure.setter
+    def structure(self, value):
+        if STRUCTURE_STORE and value is not None:
+            STRUCTURE_STORE.save(self, value)
+            self._structure = None
+            self.spilled = True
+        else:
+            self._structure = value
+        if PROGRESS and value is not None:
+            PROGRESS.extracted += 1
+        # Keywords of this node are used by itself and by its parents
+        self.invalidate_matchers()
+        for parent in self.parents:
+            parent.invalidate_matchers()
+
     def set_as_root(self):
         self.root = True
     
@@ -138,109 +935,151 @@ class DependencyNode:
     def add_dependency(self, dep):
         if not self._find_node(self.dependencies, dep):
             self.dependencies.append(dep)
+            self.invalidate_matchers()
             dep.add_parent(self)
     
     def extract_functions(self, includes):
-        if not self.file_path:
+        if not self.file_path or INCLUDE_ONLY:
             return
-        # Creating temporary directory to work with
-        with tempfile.TemporaryDirectory() as tempdir:
-            # tempdir = "./temp" # debug
+        if PROGRESS:
+            PROGRESS.current_file = self.file_path
+        if EXTRACTOR == "regex":
+            self.structure = extract_structure_with_regex(self.file_path)
+            return
+        if EXTRACTION_CACHE:
+            structure = EXTRACTION_CACHE.lookup(self.file_path, includes)
+            if structure is not None:
+                self.structure = structure
+                return
+
+        # Scratch workspace is taken from the pool and cleaned after use
+        workspace = SCRATCH_POOL.acquire()
+        try:
             extension = os.path.splitext(self.file_path)
-            prep_file_path = os.path.join(tempdir, "prep{}".format(extension[1]))
+            prep_file_path = os.path.join(workspace, "prep{}".format(extension[1]))
+            deps_file_path = os.path.join(workspace, "prep.d")
 
-            # prep_file_path = os.path.join(tempdir, os.path.basename(self.file_path))
-            # Creating temprorary file containing source code
-            with open(prep_file_path, "w+") as prep_file:
-                # Preprocessing source code
+            # Preprocessing source code. Doxygen reads only files, so gcc output
+            # is written directly to the workspace
+            with open(prep_file_path, "w") as prep_file:
                 gcc_command = ["gcc"]
                 for path in includes:
                     gcc_command.append("-I" + path)
-                gcc_command.append("-E")
-                gcc_command.append("-P")
+                gcc_command.extend(PREPROCESSOR_FLAGS)
+                if EXTRACTION_CACHE:    # List of read headers is needed to validate cache
+                    gcc_command.extend(["-MD", "-MF", deps_file_path])
                 gcc_command.append(self.file_path)
-                gcc_process = subprocess.Popen(gcc_command, stdout=prep_file)
-                gcc_process.wait()
-
-                # Run doxygen
-
-                doxy_command = ["doxygen"]
-                doxy_command.append(os.path.join(os.getcwd(), "Doxyfile"))
-                doxy_process = subprocess.Popen(doxy_command, cwd=tempdir, stdout=subprocess.DEVNULL)
+                with tracked_subprocess(gcc_command, self.file_path):
+                    gcc_process = subprocess.Popen(gcc_command, stdout=prep_file)
+                    gcc_process.wait()
+
+            digest = None
+            if EXTRACTION_CACHE and gcc_process.returncode == 0:
+                digest = EXTRACTION_CACHE.preprocessed_digest(prep_file_path)
+                dep_paths = read_make_dependencies(deps_file_path)
+                structure = EXTRACTION_CACHE.lookup_digest(digest)
+                if structure is not None:   # Same preprocessed source was already extracted
+                    EXTRACTION_CACHE.shared += 1
+                    EXTRACTION_CACHE.store(self.file_path, includes, dep_paths, digest)
+                    self.structure = structure
+                    return
+
+            # Run doxygen
+
+            doxy_command = ["doxygen"]
+            doxy_command.append(os.path.join(os.getcwd(), "Doxyfile"))
+            with tracked_subprocess(doxy_command, self.file_path):
+                doxy_process = subprocess.Popen(doxy_command, cwd=workspace, stdout=subprocess.DEVNULL)
                 doxy_process.wait()
+            os.remove(prep_file_path)   # Preprocessed source is not needed anymore
 
-                # Compiling results in one XML file using XSLT
+            # Compiling results in one XML document using XSLT. The document
+            # is parsed directly from the pipe instead of a file
 
-                # xsltproc -o output.xml combine.xslt index.xml
-                # xslt_output_file_path = os.path.join(tempdir, "xml", "xslt_output.xml")
-                # with open(xslt_output_file_path, "w+") as xslt_output_file:
-                xslt_command = ["xsltproc", "-o", "xslt_output.xml", "combine.xslt", "index.xml"]
-                xslt_process = subprocess.Popen(xslt_command, cwd=os.path.join(tempdir, "xml"), stdout=subprocess.DEVNULL)
+            xslt_command = ["xsltproc", "combine.xslt", "index.xml"]
+            with tracked_subprocess(xslt_command, self.file_path):
+                xslt_process = subprocess.Popen(xslt_command, cwd=os.path.join(workspace, "xml"), stdout=subprocess.PIPE)
+                tree = ET.parse(xslt_process.stdout)
+                xslt_process.stdout.close()
                 xslt_process.wait()
-
-                # Extract information from XML
-
-                file_structure = {
-                    "class":[],
-                    "function":[],  # TODO : Need more information to store about functions (bodystart, bodyend)
-                    "variable":[],
-                    "typedef":[]
-                }
-
-                # doxy_xml_path = os.path.join(tempdir, "xml", "{}_8{}.{}".format("prep", extension[1][1:], "xml"))
-                doxy_xml_path = os.path.join(tempdir, "xml", "xslt_output.xml")
-                with open(doxy_xml_path) as doxy_xml:
-                    tree = ET.parse(doxy_xml)
-                    root = tree.getroot()
-                    for compound in root:
-                        # Add new name of class if it is not known
-                        if not compound.get("kind") == "file" and not compound.find("compoundname").text == "std":
-                            if not compound.get("kind") in file_structure.keys():
-                                logging.debug("New compound kind '{}'".format(compound.get("kind")))
-                                file_structure[compound.get("kind")] = []
-                            # file_structure[compound.get("kind")].append(compound.find("compoundname").text)
-                            file_structure[compound.get("kind")].append({
-                                "name" : compound.find("compoundname").text,
-                                "start_line" : None,
-                                "end_line" : None,
-                            })
-
-                        for section in compound:
-                            if section.tag == "innerclass":
-                                # file_structure["class"].append(section.text)
-                                file_structure["class"].append({
-                                    "name" : section.text,
-                                    "start_line" : None,
-                                    "end_line" : None,
-                                })
-                            elif section.tag == "sectiondef":
-                                for member in section:
-                                    # Convert line numbers to int of not None 
-                                    start_line = member.find("location").get("bodystart")
-                                    if start_line:
-                                        start_line = int(start_line)
-
-                                    end_line = member.find("location").get("bodyend")
-                                    if end_line:
-                                        end_line = int(end_line)
-
-                                    struct = {
-                                        "name" : member.find("name").text,
-                                        "start_line" : start_line,
-                                        "end_line" : end_line,
-                                    }
-                                    if not member.get("kind") in file_structure.keys():
-                                        logging.warning("New type {} appeared in the file structure".format(member.find("name").text))
-                                        file_structure[member.get("kind")] = [struct]
-                                    else:
-                                        # file_structure[member.get("kind")].append(member.find("name").text)
-                                        file_structure[member.get("kind")].append(struct)
-                            # print("<{}> {} {}".format(section.tag, section.get("kind"), section.find("name")))
-                        # print(file_structure)
-
-                    self.structure = file_structure
-
-            # os.system("gcc {} > {}/prep.{}")
+            root = tree.getroot()
+
+            # Extract information from XML
+
+            file_structure = {
+                "class":[],
+                "function":[],  # TODO : Need more information to store about functions (bodystart, bodyend)
+                "variable":[],
+                "typedef":[]
+            }
+
+            for compound in root:
+                # Add new name of class if it is not known
+                if not compound.get("kind") == "file" and not compound.find("compoundname").text == "std":
+                    if not compound.get("kind") in file_structure.keys():
+                        logging.debug("New compound kind '{}'".format(compound.get("kind")))
+                        file_structure[compound.get("kind")] = []
+                    # file_structure[compound.get("kind")].append(compound.find("compoundname").text)
+                    file_structure[compound.get("kind")].append({
+                        "name" : compound.find("compoundname").text,
+                        "start_line" : None,
+                        "end_line" : None,
+                    })
+
+                for section in compound:
+                    if section.tag == "innerclass":
+                        # file_structure["class"].append(section.text)
+                        file_structure["class"].append({
+                            "name" : section.text,
+                            "start_line" : None,
+                            "end_line" : None,
+                        })
+                    elif section.tag == "sectiondef":
+                        for member in section:
+                            # Convert line numbers to int of not None 
+                            start_line = member.find("location").get("bodystart")
+                            if start_line:
+                                start_line = int(start_line)
+
+                            end_line = member.find("location").get("bodyend")
+                            if end_line:
+                                end_line = int(end_line)
+
+                            struct = {
+                                "name" : member.find("name").text,
+                                "start_line" : start_line,
+                                "end_line" : end_line,
+                            }
+                            if not member.get("kind") in file_structure.keys():
+                                logging.warning("New type {} appeared in the file structure".format(member.find("name").text))
+                                file_structure[member.get("kind")] = [struct]
+                            else:
+                                # file_structure[member.get("kind")].append(member.find("name").text)
+                                file_structure[member.get("kind")].append(struct)
+                    # print("<{}> {} {}".format(section.tag, section.get("kind"), section.find("name")))
+                # print(file_structure)
+
+            self.structure = file_structure
+            if digest:
+                EXTRACTION_CACHE.misses += 1
+                EXTRACTION_CACHE.store(self.file_path, includes, dep_paths, digest, file_structure)
+        finally:
+            SCRATCH_POOL.release(workspace)
+
+    def add_required_functions(self, required_functions):
+        # Union of required functions, used to merge partial results
+        for name, func_list in required_functions.items():
+            if not name in self.required_functions.keys():
+                self.required_functions[name] = list(func_list)
+                continue
+            for func in func_list:
+                is_in_required = False
+                for existing_func in self.required_functions[name]:
+                    if self._compare_functions(existing_func, func):
+                        is_in_required = True
+                        break
+                if not is_in_required:
+                    self.required_functions[name].append(func)
 
     def _compare_functions(self, f1, f2):
         if f1['name'] == f2['name'] and \
@@ -274,12 +1113,40 @@ class DependencyNode:
         
         new_target_lines.append((current_start, current_end))
 
-        logging.debug("Combined target lines : " + str(new_target_lines))
+        logging.debug("Combined target lines : %s", new_target_lines)
 
         return new_target_lines[1:]
 
-    def find_used_functions(self):
-            
+    def invalidate_matchers(self):
+        self._matchers = None
+        if STRUCTURE_STORE:
+            STRUCTURE_STORE.charge(self, self._derived_size())
+
+    def drop_derived(self):
+        # Called by the store on eviction, it has already released the memory
+        self._matchers = None
+        self._line_offsets = None
+
+    def _derived_size(self):
+        # Memory of keyword tables, compiled patterns and line offsets. Entries
+        # of the tables refer to the structures, which are counted by the store
+        size = 0
+        if self._matchers:
+            keywords_table, file_functions, pattern, local_pattern = self._matchers
+            for table in (keywords_table, file_functions):
+                size += sys.getsizeof(table)
+                for entries in table.values():
+                    size += sys.getsizeof(entries) + sum(sys.getsizeof(entry) for entry in entries)
+            size += sys.getsizeof(pattern) + sys.getsizeof(local_pattern)
+        if self._line_offsets is not None:
+            size += len(self._line_offsets) * self._line_offsets.itemsize
+        return size
+
+    def _build_matchers(self):
+        # Keyword tables and patterns depend only on the structures of this node
+        # and its dependencies, so they are built once and reused until
+        # the set of dependencies changes
+
         # TODO : ADD GLOBAL VARIABLES TOO
         # Go through dependencies and make dictionary of them
         keywords_table = {}
@@ -292,6 +1159,8 @@ class DependencyNode:
                 continue
             if not dep.file_path:
                 logging.warning("file '{}' not found to find usages".format(dep.name))
+                if TRACER and TRACER.enabled("miss"):
+                    TRACER.event("miss", kind="dependency", node=self.name, name=dep.name)
                 continue
             # logging.debug("dep '{}'".format(dep.name))
             # logging.debug("path='{}'".format(dep.file_path))
@@ -334,26 +1203,52 @@ class DependencyNode:
                     file_functions[func["name"]].append((self, func))
             else:
                 file_functions[func["name"]] = [(self, func)]
+
+        pattern = "\\b" + "\\b|\\b".join(keywords_table.keys()) + "\\b"  # regex pattern to find keywords from dependencies
+        local_pattern = "\\b" + "\\b|\\b".join(file_functions.keys()) + "\\b" # Pattern to find local file functions
+
+        return keywords_table, file_functions, re.compile(pattern), re.compile(local_pattern)
+
+    def _entity_at_line(self, line):
+        # The smallest required entity of this node which body contains the line
+        entity = None
+        entity_size = None
+        for name, func_list in self.required_functions.items():
+            for func in func_list:
+                if not func["start_line"] or not func["end_line"]:
+                    continue
+                if func["start_line"] <= line <= func["end_line"] or \
+                   (func["end_line"] == -1 and func["start_line"] == line):
+                    size = func["end_line"] - func["start_line"]
+                    if entity_size is None or size < entity_size:
+                        entity = name
+                        entity_size = size
+        return entity
+
+    def find_used_functions(self):
+        matchers = self._matchers
+        if matchers is None:
+            matchers = self._matchers = self._build_matchers()
+            if STRUCTURE_STORE:  # Charging may evict a dependency and invalidate the matchers again
+                STRUCTURE_STORE.charge(self, self._derived_size())
+        keywords_table, file_functions, pattern, local_pattern = matchers
         
-        logging.debug("Processing functions at '{}', path='{}', required functions : {}".format(self.name, self.file_path, str(self.required_functions.keys())))
+        logging.debug("Processing functions at '%s', path='%s', required functions : %s", self.name, self.file_path, self.required_functions.keys())
         # logging.debug("is subset : {}".format(str(OrderedSet(file_functions.keys()).issubset(keywords_table.keys()))))
 
         # Find subset of included keywords
-        appeared_keywords = set()   # TODO : FIX, ORDERED SET IS GIVING STABLE RESULTS
+        appeared_keywords = {}  # keyword -> line where it is found first
 
-        pattern = "\\b" + "\\b|\\b".join(keywords_table.keys()) + "\\b"  # regex pattern to find keywords from dependencies
-        logging.debug("Pattern applied '{}'".format(pattern))
-        if not pattern:
+        logging.debug("Pattern applied '%s'", pattern.pattern)
+        if not pattern.pattern:
             logging.warning("No keywords for '{}', path '{}'".format(self.name, self.file_path))
             return []
 
-        local_pattern = "\\b" + "\\b|\\b".join(file_functions.keys()) + "\\b" # Pattern to find local file functions
-
-
         if self.root:   # If it is a root node, go through the whole file
             with open(self.file_path) as f:
                 for str_idx, content in enumerate(f):
-                    [appeared_keywords.add(key) for key in re.findall(pattern, content)]
+                    for key in pattern.findall(content):
+                        appeared_keywords.setdefault(key, str_idx + 1)
         else:
             # Create list of needed lines
 
@@ -370,33 +1265,33 @@ class DependencyNode:
 
             used_local_functions = set(self.required_functions.keys())  # TODO Can be ordered set, but not sure
 
-            # re.findall if needed line is reached
-            with open(self.file_path) as f:
+            # Only the ranges of the needed bodies are read, every round
+            # slices its new ranges directly from the memory-mapped file
+            line_index = LineIndex(self.file_path, self._line_offsets)
+            if line_index.offsets is not self._line_offsets:
+                self._line_offsets = line_index.offsets
+                if STRUCTURE_STORE:
+                    STRUCTURE_STORE.charge(self, self._derived_size())
+            try:
                 while new_target_lines: # While we have something new to add
                     # target_lines = sorted(new_target_lines, key=lambda x : x[0])
                     target_lines = self._find_file_coverage(new_target_lines)
-                    current_range_idx = 0
-
-                    new_target_lines.clear()
-
-                    for str_idx, content in enumerate(f):
-                        if current_range_idx == len(target_lines):
-                            break   # No more ranges left
-                        current_range = target_lines[current_range_idx]
-                        if isinstance(current_range[0], str):
-                            logging.debug("str found instead of int '{}'".format(current_range[0]))
-                        if isinstance(current_range[1], str):
-                            logging.debug("str found instead of int '{}'".format(current_range[1]))
-
-                        # Append result of re.findall if it is body of needed element
-                        if (current_range[0] - 1 <= str_idx and str_idx <= current_range[1] - 1) \
-                            or (current_range[1] == -1 and current_range[0] - 1 == str_idx):
+                    new_target_lines = []
+
+                    for start_line, end_line in target_lines:
+                        if end_line == -1:
+                            end_line = start_line
+                        for line_number, content in line_index.lines(start_line, end_line):
                             # Add found keywords
-                            # [appeared_keywords.add(key) for key in re.findall(pattern, content)]
-                            for key in re.findall(pattern, content):
-                                appeared_keywords.add(key)
+                            for key in pattern.findall(content):
+                                appeared_keywords.setdefault(key, line_number)
                             # Add new functions ranges for the next iteration
-                            for local_func_name in re.findall(local_pattern, content):
+                            for local_func_name in local_pattern.findall(content):
+                                # Recorded even for required callees, they can be
+                                # required by another entity (or shard) first
+                                if PROVENANCE_INDEX:
+                                    PROVENANCE_INDEX.add(self, local_func_name, self, \
+                                                         self._entity_at_line(line_number), line_number)
                                 if local_func_name in used_local_functions:
                                     continue
                                 used_local_functions.add(local_func_name)
@@ -419,38 +1314,32 @@ class DependencyNode:
                                     if not local_func["start_line"] or not local_func["end_line"]:
                                         continue
                                     new_target_lines.append((local_func["start_line"], local_func["end_line"]))
-
-                        # if str_idx >= current_range[1] - 1:   # Current range is ended
-                        #     prev_range = current_range
-                        #     current_range_idx += 1
-                        #     # Also check if there are repeating ranges
-                        #     while current_range_idx != len(target_lines) and \
-                        #           target_lines[current_range_idx][0] == prev_range[0] and \
-                        #           target_lines[current_range_idx][1] == prev_range[1]:
-                        #         current_range_idx += 1
-
-                        # while   current_range_idx != len(target_lines) and \
-                        #         str_idx > target_lines[current_range_idx][1] - 1:
-                        #     current_range_idx += 1
-                        if str_idx == target_lines[current_range_idx][1] - 1:
-                            # If at the of current range, increase counter
-                            current_range_idx += 1
+            finally:
+                line_index.close()
 
         # Add required functions to corresponding nodes
-        logging.debug("keys found in '{}'".format(self.file_path))
+        logging.debug("keys found in '%s'", self.file_path)
+        if TRACER and TRACER.enabled("keywords"):
+            TRACER.event("keywords", node=self.name, count=len(appeared_keywords), keys=sorted(appeared_keywords))
         updated_nodes = []
         for key in appeared_keywords:
             if not key in keywords_table.keys():
                 logging.warning("Unknown key was found ({})".format(key))
+                if TRACER and TRACER.enabled("miss"):
+                    TRACER.event("miss", kind="key", node=self.name, name=key)
                 continue
             for keyword_node, keyword_function in keywords_table[key]:
+                if PROVENANCE_INDEX:
+                    line = appeared_keywords[key]
+                    PROVENANCE_INDEX.add(keyword_node, key, self, \
+                                         None if self.root else self._entity_at_line(line), line)
                 # if key in keyword_node.structure["function"]:
                 # keyword_node.required_functions.add(keyword_function)
 
                 # TODO : Need to check functions if there was a recursive call or external.
 
                 if not key in keyword_node.required_functions.keys():
-                    logging.debug("found key: '{}' from '{}'".format(key, keyword_node.name))
+                    logging.debug("found key: '%s' from '%s'", key, keyword_node.name)
                     keyword_node.required_functions[key] = [keyword_function]
                 else:
                     # Check if this function is already there
@@ -473,54 +1362,140 @@ class DependencyNode:
         return updated_nodes
 
 
-class Analyzer:
-        
-    def _extract_files_from_dirs(self, dirs):
-        # search_files = {}
-        search_files = []
-        filenames = []
-        duplicating = {}
+class SourceInventory:
+    # Single pass over all directories from target_files.json. Every directory
+    # is scanned once even if it is used by several roles (Dirs, Search_dirs,
+    # Edge_search_dirs) or nested into another one. Listings are saved with
+    # directory mtimes, so only changed directories are scanned again.
+    def __init__(self, role_dirs, cache_path):
+        self.role_dirs = role_dirs  # role -> [dir_path, ..]
+        self.listings = {}  # dir_path -> {"mtime", "files", "subdirs"}
+        self.roles = {}     # file_path -> set of roles
+        self.duplicating = {}   # filename -> [file_path, ..]
+        self.scanned_dirs = 0
+        self.changed = False
+
+        cached_listings = self._load(cache_path)
+        self.role_files = {}
+        for role, dirs in role_dirs.items():
+            self.role_files[role] = self._collect(dirs, role, cached_listings)
+
+        for name, file_paths in self.duplicating.items():
+            if len(file_paths) > 1:
+                logging.warning("Duplicating files are found ({}) -> {}".format(name, file_paths))
+
+        if cache_path and self.changed:
+            self._save(cache_path)
+        logging.info("Inventory: {} directories scanned, {} taken from cache".format(\
+            self.scanned_dirs, len(self.listings) - self.scanned_dirs))
+
+    def _load(self, cache_path):
+        if not cache_path or not os.path.isfile(cache_path):
+            return {}
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            logging.warning("Inventory cache '{}' can't be read".format(cache_path))
+            return {}
+        if cache.get("cwd") != os.getcwd() or cache.get("formats") != list(FORMATS):
+            return {}
+        return cache["dirs"]
+
+    def _save(self, cache_path):
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())   # Shards can save it at the same time
+        with open(tmp_path, "w") as f:
+            json.dump({"cwd" : os.getcwd(), "formats" : list(FORMATS), "dirs" : self.listings}, f)
+        os.replace(tmp_path, cache_path)
+
+    def _scan(self, dir_path):
+        files = []
+        subdirs = []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():  # os.walk doesn't follow links as well
+                        subdirs.append(entry.path)
+                elif entry.name.endswith(FORMATS):
+                    files.append(entry.path)
+        self.scanned_dirs += 1
+        self.changed = True
+        return {"files" : files, "subdirs" : subdirs}
+
+    def _listing(self, dir_path, cached_listings):
+        listing = self.listings.get(dir_path)
+        if listing:
+            return listing
+        try:
+            mtime = os.stat(dir_path).st_mtime_ns
+            listing = cached_listings.get(dir_path)
+            if not listing or listing["mtime"] != mtime:
+                listing = self._scan(dir_path)
+                listing["mtime"] = mtime
+        except OSError:
+            logging.warning("Directory '{}' can't be read".format(dir_path))
+            listing = {"mtime" : None, "files" : [], "subdirs" : []}
+        self.listings[dir_path] = listing
+        return listing
+
+    def _collect(self, dirs, role, cached_listings):
+        # Files are listed in the same order as os.walk does:
+        # files of the directory first, then its subdirectories
+        files = []
         for dir_path in dirs:
-            for root, directories, files in  os.walk(dir_path):
-                for f in files:
-                    if not any(ext in f for ext in FORMATS):
-                        continue
-                    file_path = os.path.join(root,f)
-                    # if file_path in files:
-                    if f in filenames:
-                        logging.warning("Duplicating files are found '{}'".format(f))
-                        # duplicating.append(f)
-                        if f in duplicating.keys():
-                            duplicating[f].append(file_path)
-                        else:
-                            duplicating[f] = [file_path]
-                    else:
-                        # search_files[f] = file_path
-                        search_files.append(file_path)
-                    # search_filenames.append(f)
-                    # search_filepaths.append(file_path)
-
-        # Print duplicates
-        for name, file_paths in duplicating.items():
-            print("({}) -> {}".format(name, file_paths))
-        
-        return search_files
+            stack = [dir_path]
+            while stack:
+                listing = self._listing(stack.pop(), cached_listings)
+                for file_path in listing["files"]:
+                    files.append(file_path)
+                    file_roles = self.roles.setdefault(file_path, set())
+                    if not role in file_roles:
+                        file_roles.add(role)
+                        same_names = self.duplicating.setdefault(os.path.basename(file_path), [])
+                        if not file_path in same_names:
+                            same_names.append(file_path)
+                stack.extend(reversed(listing["subdirs"]))
+        return files
+
+    def files_with_role(self, role):
+        return list(self.role_files[role])
+
+def suffix_index(paths):
+    # Every path by all its trailing components, e.g. 'a/b/c.h' by 'c.h', 'b/c.h'
+    # and 'a/b/c.h'. The first path in the list wins like in a linear search
+    index = {}
+    for path in paths:
+        parts = path.split("/")
+        for idx in range(len(parts)):
+            index.setdefault("/".join(parts[idx:]), path)
+    return index
+
+class Analyzer:
 
     def __init__(self, json_file):
         self.targets = None
         self.known_dependencies = []
         self.edge_dependencies = []
+        self.known_by_name = {} # name -> node for the nodes found while building the graph
+        self.edge_by_name = {}
         self.root_nodes = []
         self.processing_stack = []
-        with open(TARGETS_JSON_FILE) as json_file:
-            self.targets = json.load(json_file)
+        self.not_found_files = OrderedSet()
+        self.phase_stats = collections.OrderedDict()  # phase -> {seconds, peak_rss_mb}
+        with open(json_file) as targets_file:
+            self.targets = json.load(targets_file)
         self.starting_files = []
 
         # Find files to start with
         if PROCESS_FILES:
             self.starting_files = self.targets["Files"]
+        # All directories are listed in one pass
+        with self.phase("inventory"):
+            self.inventory = SourceInventory({role : self.targets[role] for role in INVENTORY_ROLES}, \
+                                             INVENTORY_CACHE_FILE)
+
         if PROCESS_DIRS:
-            new_files = self._extract_files_from_dirs(self.targets['Dirs'])
+            new_files = self.inventory.files_with_role('Dirs')
             if self.starting_files:
                 self.starting_files.extend(new_files)
             else:
@@ -528,15 +1503,22 @@ class Analyzer:
         self.starting_files = list(set(self.starting_files))
 
         # Extracting files to search
-        self.search_files = self._extract_files_from_dirs(self.targets['Search_dirs'])
+        self.search_files = self.inventory.files_with_role('Search_dirs')
         self.search_files.extend(self.starting_files)
 
         # Extracting files to search edge files
-        self.edge_dirs = self._extract_files_from_dirs(self.targets['Edge_search_dirs'])
+        self.edge_dirs = self.inventory.files_with_role('Edge_search_dirs')
+
+        # Includes are looked up by their trailing path components
+        self.search_index = suffix_index(self.search_files)
+        self.edge_index = suffix_index(self.edge_dirs)
 
         # Preprocessing includes
         self.preprocessing_includes = self.targets["Preprocessing_includes"]
 
+        if EXTRACTION_CACHE:
+            EXTRACTION_CACHE.set_tree_root([path for role in INVENTORY_ROLES for path in self.targets[role]])
+
     def is_known_node(self, dep):
         for d in self.known_dependencies:
             if d.file_path == dep.file_path:
@@ -544,30 +1526,21 @@ class Analyzer:
         return False
     
     def is_known_dep_name(self, d_name):
-        for d in self.known_dependencies:
-            if d.name == d_name:
-                return d
-        return None
+        return self.known_by_name.get(d_name)
     
     def is_edge_dep_name(self, d_name):
-        for d in self.edge_dependencies:
-            if d.name == d_name:
-                return d
-        return None
+        return self.edge_by_name.get(d_name)
 
     def find_file(self, dependecy_name):
-        # print("DEP : {}".format(dependecy_name))
-        for path in self.search_files:
-            if path.endswith(dependecy_name):
-                # print(path)
-                return path
-        return None
+        return self.search_index.get(dependecy_name)
 
     def find_edge_filepath(self, edge_dep_name):
-        for path in self.edge_dirs:
-            if path.endswith(edge_dep_name):
-                return path
+        path = self.edge_index.get(edge_dep_name)
+        if path:
+            return path
         logging.warning("Edge dependency '{}' filepath not found ".format(edge_dep_name))
+        if TRACER and TRACER.enabled("miss"):
+            TRACER.event("miss", kind="edge_file", name=edge_dep_name)
         return None
 
     def find_includes(self, dep_node):
@@ -675,6 +1648,54 @@ class Analyzer:
                 entities_count += 1
         print("\n{}/{} modules used, {} entities required".format(used_modules_count, len(self.edge_dependencies), entities_count))
 
+    def compute_edge_closure(self):
+        # Edge files transitively included by every node as a bitset over
+        # indices of self.edge_dependencies. Nodes of one include cycle share
+        # the same set, components are processed from the leaves
+        edge_bits = {node.node_id : 1 << idx for idx, node in enumerate(self.edge_dependencies)}
+        reachable = {}  # node_id -> bitset
+        for component in strongly_connected_components(self.root_nodes):
+            component_ids = set(node.node_id for node in component)
+            mask = 0
+            for node in component:
+                mask |= edge_bits.get(node.node_id, 0)
+                for dep in node.dependencies:
+                    if not dep.node_id in component_ids:
+                        mask |= reachable[dep.node_id]
+            for node in component:
+                reachable[node.node_id] = mask
+        return reachable
+
+    def print_edge_closure_report(self):
+        print("#################### Include closure report ####################")
+        reachable = self.compute_edge_closure()
+        roots_per_edge = [[] for _ in self.edge_dependencies]
+        for root in sorted(self.root_nodes, key=lambda x : x.name):
+            edge_indices = list(iterate_bits(reachable[root.node_id]))
+            for idx in edge_indices:
+                roots_per_edge[idx].append(root.name)
+            names = sorted(self.edge_dependencies[idx].name for idx in edge_indices)
+            print("Root '{}' reaches {} : {}".format(root.name, len(names), names))
+
+        print("")
+        filtered_edges = sorted(zip(self.edge_dependencies, roots_per_edge), key=lambda x : len(x[1]))
+        for d, roots in filtered_edges:
+            if len(roots) <= 3 or PRINT_ALL:
+                print("'{}' reachable from {} : {}".format(d.name, len(roots), roots))
+            else:
+                print("'{}' reachable from {}".format(d.name, len(roots)))
+        print("Overall edge files: {}".format(len(self.edge_dependencies)))
+
+    def find_required_entity(self, module, entity):
+        for node in self.edge_dependencies + self.known_dependencies:
+            if node.name == module and entity in node.required_functions.keys():
+                return node
+        return None
+
+    def print_why(self, module, entity):
+        node = self.find_required_entity(module, entity)
+        print_requirement_chain(module, entity, PROVENANCE_INDEX.why(node, entity) if node else None)
+
     def print_debug_structures(self):
         processing_queue = deque()
         for node in self.root_nodes:
@@ -697,13 +1718,15 @@ class Analyzer:
                 processing_queue.append(dep)
                 processed_names.add(dep.name)
 
-    def resolve(self):
+    def build_graph(self):
         # Loading starting files
         for f in self.starting_files:
             root_node = DependencyNode(f, os.path.basename(f), None, self.preprocessing_includes)
             root_node.set_as_root()
             self.root_nodes.append(root_node)
             self.processing_stack.append(root_node)
+            if PROGRESS:
+                PROGRESS.discovered = len(self.root_nodes)
 
         # Building trees. There are 3 states of files: 
         # new -> not processed yet, 
@@ -711,6 +1734,9 @@ class Analyzer:
         # edge -> not found in search diorectories, leaf node.
         while self.processing_stack:
             current_file = self.processing_stack.pop()
+            if PROGRESS:
+                PROGRESS.step(current_file.file_path, len(self.processing_stack))
+                PROGRESS.discovered = len(self.root_nodes) + len(self.known_dependencies) + len(self.edge_dependencies)
             # if current_file in self.known_dependencies:
             # if self.is_known_node(current_file):
             #     continue
@@ -737,58 +1763,419 @@ class Analyzer:
                                 d_node = DependencyNode(d_path, d_name, current_file, self.preprocessing_includes)
                             self.processing_stack.append(d_node)
                             self.known_dependencies.append(d_node)
+                            self.known_by_name[d_name] = d_node
                         else:
                             d_node = DependencyNode(d_path, d_name, current_file, self.preprocessing_includes)
                             self.edge_dependencies.append(d_node)
+                            self.edge_by_name[d_name] = d_node
 
+    def extract_edges(self):
         # Processing edge files
-        not_found_files = OrderedSet()
-
-        for e_node in self.edge_dependencies:
+        for e_index, e_node in enumerate(self.edge_dependencies):
             e_node.file_path = self.find_edge_filepath(e_node.name)
             if not e_node.file_path:
-                not_found_files.add(e_node.name)
+                self.not_found_files.add(e_node.name)
             e_node.extract_functions(self.preprocessing_includes)
+            if PROGRESS:
+                PROGRESS.step(e_node.file_path, len(self.edge_dependencies) - e_index - 1)
 
+    def propagate(self, initial_nodes):
         # Analyzing dependent functions
-
+        if SCHEDULER == "fifo":
+            visits = self._propagate_fifo(initial_nodes)
+        else:
+            visits = self._propagate_scc(initial_nodes)
+        sys.stderr.write("Propagation ({} scheduler): {} node visits, {} requeues\n".format(\
+            SCHEDULER, sum(visits.values()), sum(visits.values()) - len(visits)))
+
+    def _process_node(self, current_node, visits, queue_length):
+        logging.debug("Code processing queue - current node : '%s'", current_node.name)
+        visits[current_node.node_id] += 1
+        if PROGRESS:
+            PROGRESS.visits += 1
+        if TRACER and TRACER.enabled("visit"):
+            TRACER.event("visit", node=current_node.name, path=current_node.file_path, \
+                         visit=visits[current_node.node_id], queue=queue_length, \
+                         required=len(current_node.required_functions))
+        return current_node.find_used_functions()
+
+    def _propagate_fifo(self, initial_nodes):
         # Queue to use
         code_processing_queue = deque()
         names_in_queue = set()    # Paths that are already in the queue
 
-        # Process root nodes first
-        for node in self.root_nodes:
+        # Process initial (root) nodes first
+        for node in initial_nodes:
+            if node.name in names_in_queue:
+                continue
             code_processing_queue.append(node)
             # names_in_queue = set()
             names_in_queue.add(node.name)
 
+        visits = collections.Counter()  # node_id -> number of times processed
+
         while code_processing_queue:
             current_node = code_processing_queue.popleft()
             names_in_queue.remove(current_node.name)
-            if current_node.name in not_found_files:
+            if current_node.name in self.not_found_files:
                 continue
             
-            logging.debug("Code processing queue - current node : '{}'".format(current_node.name))
-            updated_deps = current_node.find_used_functions()
+            if PROGRESS:
+                PROGRESS.step(current_node.file_path, len(code_processing_queue))
+            updated_deps = self._process_node(current_node, visits, len(code_processing_queue))
             # for dep in current_node.dependencies:
             for dep in updated_deps:
                 if not dep.name in names_in_queue:
                     code_processing_queue.append(dep)
                     names_in_queue.add(dep.name)
-        
+                    if TRACER and TRACER.enabled("requeue"):
+                        TRACER.event("requeue", node=dep.name, by=current_node.name, visits=visits[dep.node_id])
+
+        return visits
+
+    def _propagate_scc(self, initial_nodes):
+        # Include graph is condensed into strongly connected components which
+        # are processed in topological order from the roots. A node is processed
+        # only after all its parents are done, so it is visited once unless it
+        # is a part of an include cycle, where the fixpoint is iterated
+        components = strongly_connected_components(initial_nodes)
+        components.reverse()    # Parents before dependencies
+
+        pending = {node.node_id : node for node in initial_nodes}   # Nodes having new requirements
+        visits = collections.Counter()  # node_id -> number of times processed
+
+        for component in components:
+            component_ids = set(node.node_id for node in component)
+            worklist = deque(node for node in component if node.node_id in pending)
+
+            while worklist:
+                current_node = worklist.popleft()
+                del pending[current_node.node_id]
+                if current_node.name in self.not_found_files:
+                    continue
+
+                if PROGRESS:
+                    PROGRESS.step(current_node.file_path, len(pending), len(worklist))
+                updated_deps = self._process_node(current_node, visits, len(pending))
+                for dep in updated_deps:
+                    if dep.node_id in pending:
+                        continue
+                    pending[dep.node_id] = dep
+                    if dep.node_id in component_ids:
+                        worklist.append(dep)
+                    if TRACER and TRACER.enabled("requeue"):
+                        TRACER.event("requeue", node=dep.name, by=current_node.name, visits=visits[dep.node_id])
+
+        return visits
+
+    def print_results(self):
         # Output needed results
         self.print_edge_deps()
 
         self.print_edge_functions_report()
 
+        for module, entity in WHY_QUERIES:
+            self.print_why(module, entity)
+
+        if STRUCTURE_STORE:
+            STRUCTURE_STORE.report()
+
         # self.print_debug_structures()
 
-        
-            
-            
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Wall time of the phase and peak RSS of the process at its end
+        start = time.perf_counter()
+        if PROGRESS:
+            PROGRESS.start_phase(name)
+        yield
+        if PROGRESS:
+            PROGRESS.end_phase()
+        self.phase_stats[name] = {
+            "seconds" : time.perf_counter() - start,
+            "peak_rss_mb" : peak_rss_mb(),
+        }
+
+    def save_phase_stats(self):
+        if not PHASE_STATS_FILE:
+            return
+        with open(PHASE_STATS_FILE, "w") as f:
+            json.dump(self.phase_stats, f, indent=4)
 
-        
-        
+    def resolve(self):
+        with self.phase("build_graph"):
+            self.build_graph()
+        if INCLUDE_ONLY:
+            with self.phase("report"):
+                self.print_edge_deps()
+                self.print_edge_closure_report()
+            self.save_phase_stats()
+            return
+        with self.phase("extract_edges"):
+            self.extract_edges()
+        with self.phase("propagate"):
+            self.propagate(self.root_nodes)
+        with self.phase("report"):
+            self.print_results()
+            self.save_snapshot()
+        self.save_phase_stats()
+
+    def edge_summary(self):
+        return {node.name : sorted(node.required_functions.keys()) for node in self.edge_dependencies}
+
+    def save_snapshot(self):
+        # Saves the snapshot and compares the analysis with the old one if needed
+        if SNAPSHOT_FILE:
+            self.dump_partial(SNAPSHOT_FILE, 0, 1)
+        if DIFF_SNAPSHOTS:
+            print_diff(diff_summaries(snapshot_summary(DIFF_SNAPSHOTS[0]), self.edge_summary()))
+
+    # Sharded analysis. Every shard processes a part of the root files and
+    # saves its partial graph, then partial results are merged and propagation
+    # is finished on the merged graph
+
+    def _node_key(self, node, edge_ids):
+        if node.root:
+            return "root:" + node.name
+        if node.node_id in edge_ids:
+            return "edge:" + node.name
+        return "known:" + node.name
+
+    def dump_partial(self, path, shard_index, shard_count):
+        nodes = []
+        edge_ids = set(node.node_id for node in self.edge_dependencies)
+        for node in self.root_nodes + self.known_dependencies + self.edge_dependencies:
+            nodes.append({
+                "key" : self._node_key(node, edge_ids),
+                "name" : node.name,
+                "file_path" : node.file_path,
+                "header" : node.header,
+                "structure" : node.structure,
+                "required_functions" : node.required_functions,
+                "dependencies" : [self._node_key(dep, edge_ids) for dep in node.dependencies],
+            })
+        partial = {
+            "format" : PARTIAL_FORMAT_VERSION,
+            "shard" : shard_index,
+            "shard_count" : shard_count,
+            "root_files" : self.starting_files,
+            "not_found_files" : list(self.not_found_files),
+            "nodes" : nodes,
+        }
+        if PROVENANCE_INDEX:
+            partial["provenance"] = [[self._node_key(node, edge_ids), entity, \
+                                      self._node_key(source_node, edge_ids), source_entity, line] \
+                                     for node, entity, source_node, source_entity, line in PROVENANCE_INDEX.edges()]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(partial, f)
+        os.replace(tmp_path, path)  # Other hosts should never see half written file
+
+    def resolve_shard(self, shard_index, shard_count, output_dir):
+        self.starting_files = sorted(self.starting_files)[shard_index::shard_count]
+        self.build_graph()
+        self.extract_edges()
+        self.propagate(self.root_nodes)
+
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, SHARD_NAME_FORMAT.format(shard_index, shard_count))
+        self.dump_partial(path, shard_index, shard_count)
+        logging.info("Shard {}/{} is saved to '{}'".format(shard_index, shard_count, path))
+        return path
+
+    def load_partials(self, paths):
+        nodes = {}  # key -> node
+        node_dependencies = []   # [(node, dependency keys), ..]
+        self.starting_files = []
+        shards = set()
+        shard_count = None
+
+        for path in paths:
+            with open(path) as f:
+                partial = json.load(f)
+            if partial["format"] != PARTIAL_FORMAT_VERSION:
+                logging.warning("Partial result '{}' has unknown format {}".format(path, partial["format"]))
+                continue
+            shards.add(partial["shard"])
+            shard_count = partial["shard_count"]
+            self.starting_files.extend(partial["root_files"])
+            for name in partial["not_found_files"]:
+                self.not_found_files.add(name)
+
+            for node_info in partial["nodes"]:
+                key = node_info["key"]
+                node = nodes.get(key)
+                if not node:
+                    node = DependencyNode(None, node_info["name"], None, self.preprocessing_includes)
+                    node.file_path = node_info["file_path"]
+                    node.header = node_info["header"]
+                    node.structure = node_info["structure"]
+                    nodes[key] = node
+                    if key.startswith("root:"):
+                        node.set_as_root()
+                        self.root_nodes.append(node)
+                    elif key.startswith("edge:"):
+                        self.edge_dependencies.append(node)
+                    else:
+                        self.known_dependencies.append(node)
+                node.add_required_functions(node_info["required_functions"])
+                node_dependencies.append((node, node_info["dependencies"]))
+
+            if PROVENANCE_INDEX:
+                for key, entity, source_key, source_entity, line in partial.get("provenance", []):
+                    PROVENANCE_INDEX.add(nodes[key], entity, nodes[source_key], source_entity, line)
+
+        if shard_count is not None and len(shards) != shard_count:
+            logging.warning("Only {} of {} shards are merged".format(len(shards), shard_count))
+
+        for node, dependency_keys in node_dependencies:
+            for key in dependency_keys:
+                node.add_dependency(nodes[key])
+
+    def merge(self, paths):
+        with self.phase("load_partials"):
+            self.load_partials(paths)
+        if PROGRESS:
+            PROGRESS.discovered = len(self.root_nodes) + len(self.known_dependencies) + len(self.edge_dependencies)
+
+        # Finish propagation across shard boundaries. Every node that got
+        # requirements in any shard is processed again with the union of them
+        initial_nodes = self.root_nodes + [node for node in self.known_dependencies + self.edge_dependencies \
+                                           if node.required_functions]
+        with self.phase("propagate"):
+            self.propagate(initial_nodes)
+        with self.phase("report"):
+            self.print_results()
+            self.save_snapshot()
+        self.save_phase_stats()
+
+def print_requirement_chain(module, entity, chain):
+    print("#################### Why '{}' is required by '{}' ####################".format(entity, module))
+    if not chain:
+        print("No justification found")
+        return
+    for idx, (step_node, step_entity, line) in enumerate(chain):
+        if step_entity is None:
+            description = "Root '{}'".format(step_node.name)
+        else:
+            description = "{}'{}' {}".format("    " * idx, step_node.name, step_entity)
+        if line:
+            description += ", line {} of '{}'".format(line, step_node.file_path)
+        print(description)
+
+def load_provenance(path):
+    # Provenance recorded in a saved snapshot (partial result) and nodes of it
+    # by (module, entity). Edge modules are preferred like in find_required_entity
+    with open(path) as f:
+        snapshot = json.load(f)
+    if not "provenance" in snapshot:
+        logging.warning("Snapshot '{}' has no recorded requirements".format(path))
+    nodes = {}  # key -> node
+    required = {}   # (module, entity) -> node
+    for node_info in snapshot["nodes"]:
+        node = DependencyNode(None, node_info["name"], None, [])
+        node.file_path = node_info["file_path"]
+        if node_info["key"].startswith("root:"):
+            node.set_as_root()
+        nodes[node_info["key"]] = node
+    for node_info in sorted(snapshot["nodes"], key=lambda x : not x["key"].startswith("edge:")):
+        if node_info["key"].startswith("root:"):
+            continue
+        for entity in node_info["required_functions"]:
+            required.setdefault((node_info["name"], entity), nodes[node_info["key"]])
+
+    index = ProvenanceIndex()
+    for key, entity, source_key, source_entity, line in snapshot.get("provenance", []):
+        index.add(nodes[key], entity, nodes[source_key], source_entity, line)
+    return index, required
+
+def print_snapshot_why(path, queries):
+    index, required = load_provenance(path)
+    for module, entity in queries:
+        node = required.get((module, entity))
+        print_requirement_chain(module, entity, index.why(node, entity) if node else None)
+
+def snapshot_summary(path):
+    # Required entities of every edge module from a saved snapshot (partial result)
+    with open(path) as f:
+        snapshot = json.load(f)
+    return {node["name"] : sorted(node["required_functions"].keys()) \
+            for node in snapshot["nodes"] if node["key"].startswith("edge:")}
+
+def diff_summaries(old_summary, new_summary):
+    old_used = set(name for name, entities in old_summary.items() if entities)
+    new_used = set(name for name, entities in new_summary.items() if entities)
+    diff = {
+        "modules" : {
+            "added" : sorted(set(new_summary) - set(old_summary)),
+            "removed" : sorted(set(old_summary) - set(new_summary)),
+        },
+        "used_modules" : {
+            "added" : sorted(new_used - old_used),
+            "removed" : sorted(old_used - new_used),
+        },
+        "entities" : {},
+    }
+    for name in sorted(set(old_summary) | set(new_summary)):
+        old_entities = set(old_summary.get(name, []))
+        new_entities = set(new_summary.get(name, []))
+        if old_entities != new_entities:
+            diff["entities"][name] = {
+                "added" : sorted(new_entities - old_entities),
+                "removed" : sorted(old_entities - new_entities),
+            }
+    return diff
+
+def print_diff(diff):
+    print("#################### Diff ####################")
+    print(json.dumps(diff, indent=4))
+
+def find_partials(shard_dir):
+    return sorted(glob.glob(os.path.join(shard_dir, SHARD_GLOB)))
+
+def run_shard(shard_index, shard_count):
+    global STRUCTURE_STORE, TRACER, PROGRESS
+    if MEMORY_BOUNDED:
+        db_path = SPILL_DB_PATH + ".shard{}".format(shard_index) if SPILL_DB_PATH else None
+        STRUCTURE_STORE = StructureStore(db_path, MEMORY_LIMIT_MB)
+    if TRACE_FILE:
+        TRACER = Tracer(TRACE_FILE + ".shard{}".format(shard_index), TRACE_CATEGORIES, TRACE_SAMPLE_EVERY)
+    PROGRESS = start_progress(".shard{}".format(shard_index), {"shard" : shard_index})
+
+    tool = Analyzer(TARGETS_JSON_FILE)
+    tool.resolve_shard(shard_index, shard_count, SHARD_OUTPUT_DIR)
+
+    if STRUCTURE_STORE:
+        STRUCTURE_STORE.close()
+    if TRACER:
+        TRACER.close()
+    if PROGRESS:
+        PROGRESS.close()
+    SCRATCH_POOL.close()    # atexit handlers are not called in the forked processes
+
+def run_local_shards(shard_count):
+    # Run all shards as separate processes on this host and merge the results.
+    # Every shard reports its own progress, the merge is reported after them
+    # because the reporting thread must not run while forking
+    global PROGRESS
+    for old_partial in find_partials(SHARD_OUTPUT_DIR):
+        os.remove(old_partial)
+
+    context = multiprocessing.get_context("fork")
+    workers = []
+    for shard_index in range(shard_count):
+        worker = context.Process(target=run_shard, args=(shard_index, shard_count))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+        if worker.exitcode != 0:
+            logging.error("Shard process failed with exit code {}".format(worker.exitcode))
+            sys.exit(1)
+
+    PROGRESS = start_progress()
+    tool = Analyzer(TARGETS_JSON_FILE)
+    tool.merge(find_partials(SHARD_OUTPUT_DIR))
 
 def parse_args():
     usage_str = """python analysis_tool.py -h -a -c -l -f target_files.json
@@ -797,6 +2184,22 @@ def parse_args():
     -c to process only C functions and variables
     -l output logs to the file
     -f process files set in 'Files' in target_files.json
+    -i to analyze only includes (edge files reachable from every target file), can't be used with -s, -j, -M, -S, -D old_snapshot and -w
+    -m limit_mb to keep structures in a database and at most limit_mb of them (by serialized size) and their keyword tables in memory
+    -s index/count to process only one shard of root files and save partial result
+    -j count to run count shards as local processes and merge them
+    -M to merge partial results saved by shards
+    -o shard_dir directory for partial results (./shards if not set)
+    -t trace_file to write structured trace of the analysis (JSON lines)
+    -w module:entity to print why the entity of the module is required (can be repeated)
+    -W snapshot_file to answer -w queries from a saved snapshot or partial result without analysis
+    -q scc|fifo scheduler of the propagation (scc if not set)
+    -x doxygen|regex extractor of structures (doxygen if not set)
+    -P stats_file to save wall time and peak RSS of every phase
+    -p seconds to print progress of the analysis to STDERR every given seconds
+    -e metrics_file to export progress as Prometheus textfile
+    -S snapshot_file to save snapshot of the analysis
+    -D old_snapshot[,new_snapshot] to print added and removed modules and entities
     target_files.json is a path to file containing settings (./target_files.json if not set)
     The output is passed to STDOUT"""
 
@@ -804,7 +2207,7 @@ def parse_args():
     args = None
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "aclf")
+        opts, args = getopt.getopt(sys.argv[1:], "aclfim:s:j:Mo:t:w:W:S:D:q:x:P:p:e:")
     except getopt.GetoptError:
         print("Wrong arguments. Usage {}".format(usage_str))
         sys.exit(2)
@@ -827,9 +2230,68 @@ def parse_args():
         elif opt == '-f':
             global PROCESS_FILES
             PROCESS_FILES = True
+        elif opt == '-i':
+            global INCLUDE_ONLY
+            INCLUDE_ONLY = True
+        elif opt == '-m':
+            global MEMORY_BOUNDED, MEMORY_LIMIT_MB
+            MEMORY_BOUNDED = True
+            MEMORY_LIMIT_MB = int(arg)
+        elif opt == '-s':
+            global SHARD_INDEX, SHARD_COUNT
+            SHARD_INDEX, SHARD_COUNT = (int(x) for x in arg.split("/"))
+        elif opt == '-j':
+            global LOCAL_SHARDS
+            LOCAL_SHARDS = int(arg)
+        elif opt == '-M':
+            global MERGE_SHARDS
+            MERGE_SHARDS = True
+        elif opt == '-o':
+            global SHARD_OUTPUT_DIR
+            SHARD_OUTPUT_DIR = arg
+        elif opt == '-t':
+            global TRACE_FILE
+            TRACE_FILE = arg
+        elif opt == '-w':
+            WHY_QUERIES.append(tuple(arg.split(":", 1)))
+        elif opt == '-W':
+            global WHY_SNAPSHOT
+            WHY_SNAPSHOT = arg
+        elif opt == '-q':
+            global SCHEDULER
+            SCHEDULER = arg
+        elif opt == '-x':
+            global EXTRACTOR
+            EXTRACTOR = arg
+        elif opt == '-P':
+            global PHASE_STATS_FILE
+            PHASE_STATS_FILE = arg
+        elif opt == '-p':
+            global SHOW_PROGRESS, PROGRESS_INTERVAL
+            SHOW_PROGRESS = True
+            PROGRESS_INTERVAL = float(arg)
+        elif opt == '-e':
+            global METRICS_FILE
+            METRICS_FILE = arg
+        elif opt == '-S':
+            global SNAPSHOT_FILE
+            SNAPSHOT_FILE = arg
+        elif opt == '-D':
+            DIFF_SNAPSHOTS.extend(arg.split(","))
     
     if args:
+        global TARGETS_JSON_FILE
         TARGETS_JSON_FILE = args[0]
+
+    # Include only analysis has neither structures nor required entities to shard,
+    # save, compare or explain
+    if INCLUDE_ONLY:
+        conflicts = [flag for flag, used in (("-s", SHARD_INDEX is not None), ("-j", LOCAL_SHARDS), \
+                                             ("-M", MERGE_SHARDS), ("-S", SNAPSHOT_FILE), \
+                                             ("-D", len(DIFF_SNAPSHOTS) == 1), ("-w", WHY_QUERIES)) if used]
+        if conflicts:
+            print("-i can't be used with {}. Usage {}".format(", ".join(conflicts), usage_str))
+            sys.exit(2)
     
 
 if __name__ == "__main__":
@@ -841,8 +2303,53 @@ if __name__ == "__main__":
         logging.basicConfig(filename=datetime.datetime.today().strftime(LOG_NAME_FORMAT), \
                             level=LOG_LEVEL)
 
-    tool = Analyzer(TARGETS_JSON_FILE)
-    tool.resolve()
+    if len(DIFF_SNAPSHOTS) == 2:
+        print_diff(diff_summaries(snapshot_summary(DIFF_SNAPSHOTS[0]), snapshot_summary(DIFF_SNAPSHOTS[1])))
+        sys.exit(0)
+
+    if WHY_SNAPSHOT:
+        print_snapshot_why(WHY_SNAPSHOT, WHY_QUERIES)
+        sys.exit(0)
+
+    # Only doxygen extraction is cached
+    if EXTRACTION_CACHE_DIR and EXTRACTOR == "doxygen" and not INCLUDE_ONLY:
+        EXTRACTION_CACHE = ExtractionCache(EXTRACTION_CACHE_DIR, os.path.join(os.getcwd(), "Doxyfile"))
+
+    # Requirements are saved with the snapshot, so they can be explained later
+    # with -W. Shards save them in partial results if they are run with -S too
+    if WHY_QUERIES or SNAPSHOT_FILE:
+        PROVENANCE_INDEX = ProvenanceIndex()
+
+    if SHARD_INDEX is not None:
+        run_shard(SHARD_INDEX, SHARD_COUNT)
+        sys.exit(0)
+
+    if MEMORY_BOUNDED:
+        STRUCTURE_STORE = StructureStore(SPILL_DB_PATH, MEMORY_LIMIT_MB)
+
+    if TRACE_FILE:
+        TRACER = Tracer(TRACE_FILE, TRACE_CATEGORIES, TRACE_SAMPLE_EVERY)
+
+    if LOCAL_SHARDS:
+        run_local_shards(LOCAL_SHARDS)
+    elif MERGE_SHARDS:
+        PROGRESS = start_progress()
+        tool = Analyzer(TARGETS_JSON_FILE)
+        tool.merge(find_partials(SHARD_OUTPUT_DIR))
+    else:
+        PROGRESS = start_progress()
+        tool = Analyzer(TARGETS_JSON_FILE)
+        tool.resolve()
+
+    if STRUCTURE_STORE:
+        STRUCTURE_STORE.close()
+    if TRACER:
+        TRACER.close()
+    if PROGRESS:
+        PROGRESS.close()
+    if EXTRACTION_CACHE:
+        logging.info("Extraction cache: {} hits, {} shared preprocessed sources, {} misses".format(\
+            EXTRACTION_CACHE.hits, EXTRACTION_CACHE.shared, EXTRACTION_CACHE.misses))
 
     # Debug code
 
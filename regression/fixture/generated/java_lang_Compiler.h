@@ -0,0 +1 @@
+#include "jni.h"
@@ -0,0 +1,13 @@
+#include "jni.h"
+#include "jvm.h"
+#include "java_lang_Compiler.h"
+
+JNIEXPORT jboolean JNICALL Java_java_lang_Compiler_compileClass(JNIEnv *env, jclass compCls, jclass cls)
+{
+    return JVM_CompileClass(env, compCls, cls);
+}
+
+JNIEXPORT void JNICALL Java_java_lang_Compiler_disable(JNIEnv *env, jclass compCls)
+{
+    JVM_DisableCompiler(env, compCls);
+}
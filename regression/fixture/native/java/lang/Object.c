@@ -0,0 +1,18 @@
+#include "jni.h"
+#include "jvm.h"
+#include "java_lang_Object.h"
+
+static JNINativeMethod methods[] = {
+    {"hashCode", "()I", (void *)&JVM_IHashCode},
+    {"clone", "()Ljava/lang/Object;", (void *)&JVM_Clone},
+};
+
+JNIEXPORT void JNICALL Java_java_lang_Object_registerNatives(JNIEnv *env, jclass cls)
+{
+    (*env)->RegisterNatives(env, cls, methods, 2);
+}
+
+JNIEXPORT jclass JNICALL Java_java_lang_Object_getClass(JNIEnv *env, jobject this)
+{
+    return (*env)->GetObjectClass(env, this);
+}
@@ -0,0 +1,13 @@
+#include "jni.h"
+#include "jvm.h"
+#include "java_lang_Thread.h"
+
+JNIEXPORT void JNICALL Java_java_lang_Thread_yield(JNIEnv *env, jclass threadClass)
+{
+    JVM_Yield(env, threadClass);
+}
+
+JNIEXPORT jobject JNICALL Java_java_lang_Thread_currentThread(JNIEnv *env, jclass threadClass)
+{
+    return JVM_CurrentThread(env, threadClass);
+}
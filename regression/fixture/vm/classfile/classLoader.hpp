@@ -0,0 +1,16 @@
+#include "oops/oop.hpp"
+
+class ClassLoader {
+    static jboolean compile_the_world_in(jclass cls) {
+        return load_classfile(cls) != 0;
+    }
+    static int load_classfile(jclass cls) {
+        return oopDesc::identity_hash(cls);
+    }
+    static void initialize(void) {
+        return;
+    }
+};
+
+class PerfClassTraceTime {
+};
@@ -0,0 +1,14 @@
+class oopDesc {
+    static jint identity_hash(jobject obj) {
+        return slow_identity_hash(obj);
+    }
+    static jint slow_identity_hash(jobject obj) {
+        return 7;
+    }
+    static jobject clone_object(jobject obj) {
+        return obj;
+    }
+    static void verify(jobject obj) {
+        return;
+    }
+};
@@ -0,0 +1,15 @@
+#include "jni_md.h"
+
+typedef struct JNINativeInterface_ JNIEnv;
+typedef int jint;
+typedef unsigned char jboolean;
+typedef void *jobject;
+typedef jobject jclass;
+
+struct JNINativeMethod {
+    char *name;
+    char *signature;
+    void *fnPtr;
+};
+
+jint JNI_GetDefaultJavaVMInitArgs(void *args);
@@ -0,0 +1,2 @@
+typedef long jlong;
+typedef signed char jbyte;
@@ -0,0 +1,37 @@
+#include "jvm.h"
+#include "classfile/classLoader.hpp"
+#include "oops/oop.hpp"
+#include "runtime/os.hpp"
+#include "runtime/thread.hpp"
+
+static jint hash_of(jobject obj) {
+    return oopDesc::identity_hash(obj);
+}
+
+jint JVM_IHashCode(JNIEnv *env, jobject obj) {
+    return hash_of(obj);
+}
+
+jobject JVM_Clone(JNIEnv *env, jobject obj) {
+    return oopDesc::clone_object(obj);
+}
+
+jboolean JVM_CompileClass(JNIEnv *env, jclass compCls, jclass cls) {
+    return ClassLoader::compile_the_world_in(cls);
+}
+
+void JVM_DisableCompiler(JNIEnv *env, jclass compCls) {
+    return;
+}
+
+void JVM_Yield(JNIEnv *env, jclass threadClass) {
+    os::naked_yield();
+}
+
+jobject JVM_CurrentThread(JNIEnv *env, jclass threadClass) {
+    return JavaThread::current_thread_obj();
+}
+
+void JVM_Unused(void) {
+    os::abort_vm();
+}
@@ -0,0 +1,9 @@
+#include "jni.h"
+#include "jvm_misc.hpp"
+
+jint JVM_IHashCode(JNIEnv *env, jobject obj);
+jobject JVM_Clone(JNIEnv *env, jobject obj);
+jboolean JVM_CompileClass(JNIEnv *env, jclass compCls, jclass cls);
+void JVM_DisableCompiler(JNIEnv *env, jclass compCls);
+void JVM_Yield(JNIEnv *env, jclass threadClass);
+jobject JVM_CurrentThread(JNIEnv *env, jclass threadClass);
@@ -0,0 +1,5 @@
+#include "jvm_misc.hpp"
+
+void jni_check_async_exceptions(void) {
+    JVM_Yield(0, 0);
+}
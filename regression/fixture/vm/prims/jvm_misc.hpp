@@ -0,0 +1,3 @@
+#include "jvm.h"
+
+void jni_check_async_exceptions(void);
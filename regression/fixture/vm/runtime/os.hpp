@@ -0,0 +1,8 @@
+class os {
+    static void naked_yield(void) {
+        return;
+    }
+    static void abort_vm(void) {
+        return;
+    }
+};
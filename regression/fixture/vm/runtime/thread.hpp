@@ -0,0 +1,12 @@
+#include "runtime/os.hpp"
+
+class JavaThread {
+    static jobject current_thread_obj(void) {
+        return thread_obj;
+    }
+    static void run(void) {
+        os::naked_yield();
+    }
+};
+
+jobject thread_obj;
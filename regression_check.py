@@ -0,0 +1,295 @@
+import os
+import re
+import sys
+import json
+import random
+import getopt
+import tempfile
+import subprocess
+
+# Regression check of the analysis using the stand-in (regex) extractor on two
+# fixtures: the small HotSpot-like tree in regression/ and a larger tree
+# generated from a fixed seed, which makes phases long enough to be timed.
+# Modules and entities must match the baseline exactly (order is ignored),
+# wall time and peak RSS of every phase must stay within thresholds. Every
+# run is made in a new temporary directory, so no caches are reused
+
+TOOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "analisys_tool.py")
+REGRESSION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regression")
+TARGETS_FILE = os.path.join(REGRESSION_DIR, "targets.json")
+BASELINE_FILE = os.path.join(REGRESSION_DIR, "baseline.json")
+TARGET_ROLES = ("Files", "Dirs", "Search_dirs", "Edge_search_dirs", "Preprocessing_includes")
+
+# Same option sets as in generate_sample_output.sh
+OPTION_SETS = {
+    "only_C_and_alternatives" : ["-c", "-a"],
+    "only_C_and_no_alternatives" : ["-c"],
+    "not_C_and_alternatives" : ["-a"],
+    "not_C_and_no_alternatives" : [],
+}
+
+# Alternative code paths which must produce the same results
+CODE_PATHS = {
+    "default" : [],
+    "fifo" : ["-q", "fifo"],
+    "memory_bounded" : ["-m", "1"],
+    "shards" : ["-j", "2"],
+}
+
+# Generated fixture. Modules include each other (with include guards) and
+# edge headers, functions call functions of the included modules
+
+GENERATED_SEED = 1
+GENERATED_MODULES = 300
+GENERATED_EDGE_MODULES = 40
+GENERATED_ROOTS = 30
+GENERATED_FUNCTIONS = 8     # Functions per module
+
+REPEAT = 5  # The fastest of the runs is compared to reduce noise
+
+# Thresholds
+
+MAX_SLOWDOWN = 0.5          # Relative slowdown of a phase
+MAX_MEMORY_GROWTH = 0.25    # Relative growth of peak RSS
+MIN_SECONDS = 0.02          # Smaller slowdowns are ignored as noise
+MIN_MEMORY_MB = 4           # Smaller growth of peak RSS is ignored as noise
+
+UPDATE_BASELINE = False
+
+def bundled_fixture(workdir):
+    # Paths of the bundled fixture are made absolute, so the tool can run anywhere
+    with open(TARGETS_FILE) as f:
+        targets = json.load(f)
+    for role in TARGET_ROLES:
+        targets[role] = [os.path.join(REGRESSION_DIR, path) for path in targets[role]]
+    return targets
+
+def generated_fixture(workdir):
+    rng = random.Random(GENERATED_SEED)
+    root = os.path.join(workdir, "generated")
+    for sub_dir in ("roots", "modules", "edge"):
+        os.makedirs(os.path.join(root, sub_dir))
+
+    def write(path, content):
+        with open(os.path.join(root, path), "w") as f:
+            f.write(content)
+
+    def guarded(name, content):
+        guard = name.upper() + "_H"
+        return "#ifndef {0}\n#define {0}\n\n{1}\n#endif\n".format(guard, content)
+
+    def body(callees):
+        return " + ".join(callee + "()" for callee in callees)
+
+    modules = ["m{}".format(i) for i in range(GENERATED_MODULES)]
+    edge_modules = ["e{}".format(i) for i in range(GENERATED_EDGE_MODULES)]
+    functions = {module : ["{}_f{}".format(module, i) for i in range(GENERATED_FUNCTIONS)] \
+                 for module in modules + edge_modules}
+
+    for module in edge_modules:
+        write("edge/{}.h".format(module), guarded(module, \
+            "".join("int {}(void);\n".format(function) for function in functions[module])))
+
+    for module in modules:
+        includes = rng.sample([m for m in modules if m != module], 3) + rng.sample(edge_modules, 2)
+        write("modules/{}.h".format(module), guarded(module, \
+            "".join('#include "{}.h"\n'.format(include) for include in includes) + "\n" + \
+            "typedef struct {0}_state {{\n    int value;\n}} {0}_state_t;\n\n".format(module) + \
+            "".join("int {}(void);\n".format(function) for function in functions[module])))
+
+        callees = [function for include in includes for function in functions[include]]
+        source = '#include "{}.h"\n\n'.format(module)
+        for function in functions[module]:
+            local = [f for f in functions[module] if f != function]
+            source += "int {}(void) {{\n    {}_state_t state;\n    return {};\n}}\n\n".format(\
+                function, module, body(rng.sample(callees, 2) + rng.sample(local, 1)))
+        write("modules/{}.c".format(module), source)
+
+    for index in range(GENERATED_ROOTS):
+        includes = rng.sample(modules, 3)
+        callees = [function for include in includes for function in functions[include]]
+        write("roots/r{}.c".format(index), \
+            "".join('#include "{}.h"\n'.format(include) for include in includes) + \
+            "\nint main_r{}(void) {{\n    return {};\n}}\n".format(index, body(rng.sample(callees, 3))))
+
+    return {
+        "Files" : [],
+        "Dirs" : [os.path.join(root, "roots")],
+        "Search_dirs" : [os.path.join(root, "modules")],
+        "Edge_search_dirs" : [os.path.join(root, "edge")],
+        "Preprocessing_includes" : [],
+    }
+
+# Fixture -> (function creating it and returning targets, option sets to run).
+# The generated fixture is slow, so it is run only with one option set
+
+FIXTURES = {
+    "hotspot" : (bundled_fixture, list(OPTION_SETS)),
+    "generated" : (generated_fixture, ["not_C_and_alternatives"]),
+}
+
+def parse_report(output):
+    # Edge files and required entities from the output of analisys_tool.py
+    edge_files = set()
+    entities = {}
+    current_module = None
+    in_report = False
+    for line in output.splitlines():
+        if line.startswith("#################### Functions report"):
+            in_report = True
+            continue
+        if not in_report:
+            match = re.match(r"^'(.+)' used by \d+", line)
+            if match:
+                edge_files.add(match.group(1))
+            continue
+        match = re.match(r"^Module '(.+)', filepath", line)
+        if match:
+            current_module = match.group(1)
+            entities[current_module] = set()
+        elif current_module and line.startswith("    ") and line.endswith(","):
+            entities[current_module].add(line.strip()[:-1])
+        else:
+            current_module = None
+    return {
+        "edge_files" : sorted(edge_files),
+        "entities" : {module : sorted(names) for module, names in entities.items()},
+    }
+
+def run_analysis(targets_path, options, workdir):
+    # Inventory cache, shards and phase stats are written to a new directory
+    run_dir = tempfile.mkdtemp(dir=workdir)
+    stats_path = os.path.join(run_dir, "phases.json")
+    command = [sys.executable, TOOL_PATH, "-x", "regex", "-P", stats_path, \
+               "-o", os.path.join(run_dir, "shards")] + options + [targets_path]
+    process = subprocess.run(command, cwd=run_dir, stdout=subprocess.PIPE, \
+                             stderr=subprocess.DEVNULL, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError("'{}' failed with exit code {}".format(" ".join(command), process.returncode))
+    with open(stats_path) as f:
+        phases = json.load(f)
+    return parse_report(process.stdout), phases
+
+def measure(targets_path, options, workdir):
+    result = None
+    best_phases = {}
+    for _ in range(REPEAT):
+        new_result, phases = run_analysis(targets_path, options, workdir)
+        if result and new_result != result:
+            raise RuntimeError("Results differ between runs with options {}".format(options))
+        result = new_result
+        for phase, stats in phases.items():
+            best = best_phases.setdefault(phase, dict(stats))
+            best["seconds"] = min(best["seconds"], stats["seconds"])
+            best["peak_rss_mb"] = min(best["peak_rss_mb"], stats["peak_rss_mb"])
+    return result, best_phases
+
+def compare_results(name, baseline, result):
+    errors = []
+    if set(baseline["edge_files"]) != set(result["edge_files"]):
+        errors.append("{}: edge files differ, added {}, removed {}".format(name, \
+            sorted(set(result["edge_files"]) - set(baseline["edge_files"])), \
+            sorted(set(baseline["edge_files"]) - set(result["edge_files"]))))
+    for module in sorted(set(baseline["entities"]) | set(result["entities"])):
+        old_entities = set(baseline["entities"].get(module, []))
+        new_entities = set(result["entities"].get(module, []))
+        if old_entities != new_entities:
+            errors.append("{}: entities of '{}' differ, added {}, removed {}".format(name, module, \
+                sorted(new_entities - old_entities), sorted(old_entities - new_entities)))
+    return errors
+
+def compare_phases(name, baseline, phases):
+    errors = []
+    for phase, old_stats in baseline.items():
+        new_stats = phases.get(phase)
+        if not new_stats:
+            errors.append("{}: phase '{}' is missing".format(name, phase))
+            continue
+        old_seconds, new_seconds = old_stats["seconds"], new_stats["seconds"]
+        if new_seconds > old_seconds * (1 + MAX_SLOWDOWN) and new_seconds - old_seconds > MIN_SECONDS:
+            errors.append("{}: phase '{}' is slower, {:.3f}s instead of {:.3f}s".format(\
+                name, phase, new_seconds, old_seconds))
+        old_rss, new_rss = old_stats["peak_rss_mb"], new_stats["peak_rss_mb"]
+        if new_rss > old_rss * (1 + MAX_MEMORY_GROWTH) and new_rss - old_rss > MIN_MEMORY_MB:
+            errors.append("{}: phase '{}' uses more memory, {:.1f} MB instead of {:.1f} MB".format(\
+                name, phase, new_rss, old_rss))
+    return errors
+
+def check():
+    baseline = {}
+    if not UPDATE_BASELINE:
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+
+    new_baseline = {"results" : {}, "phases" : {}}
+    errors = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for fixture_name, (make_fixture, set_names) in FIXTURES.items():
+            targets_path = os.path.join(workdir, fixture_name + ".json")
+            with open(targets_path, "w") as f:
+                json.dump(make_fixture(workdir), f, indent=4)
+
+            for set_name in set_names:
+                set_options = OPTION_SETS[set_name]
+                result_name = "{}/{}".format(fixture_name, set_name)
+                for path_name, path_options in CODE_PATHS.items():
+                    name = "{}/{}".format(result_name, path_name)
+                    result, phases = measure(targets_path, set_options + path_options, workdir)
+                    new_baseline["phases"][name] = phases
+                    if path_name == "default":
+                        new_baseline["results"][result_name] = result
+                    if UPDATE_BASELINE:
+                        # Every code path must agree with the default one even for a new baseline
+                        errors.extend(compare_results(name, new_baseline["results"][result_name], result))
+                        continue
+
+                    run_errors = compare_results(name, baseline["results"][result_name], result)
+                    if name in baseline["phases"]:
+                        run_errors.extend(compare_phases(name, baseline["phases"][name], phases))
+                    print("{} {}".format("FAIL" if run_errors else "OK  ", name))
+                    errors.extend(run_errors)
+
+    for error in errors:
+        print(error)
+
+    if UPDATE_BASELINE and not errors:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(new_baseline, f, indent=4, sort_keys=True)
+        print("Baseline is saved to '{}'".format(BASELINE_FILE))
+
+    return not errors
+
+def parse_args():
+    usage_str = """python regression_check.py -h -u -s max_slowdown -m max_memory_growth -t min_seconds
+    -h for help
+    -u to save new baseline (code paths are still checked against each other)
+    -s max_slowdown relative slowdown of a phase treated as regression (0.5 if not set)
+    -m max_memory_growth relative growth of peak RSS treated as regression (0.25 if not set)
+    -t min_seconds slowdown of a phase ignored as noise whatever the relative slowdown is (0.02 if not set)"""
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hus:m:t:")
+    except getopt.GetoptError:
+        print("Wrong arguments. Usage {}".format(usage_str))
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage_str)
+            sys.exit(0)
+        elif opt == '-u':
+            global UPDATE_BASELINE
+            UPDATE_BASELINE = True
+        elif opt == '-s':
+            global MAX_SLOWDOWN
+            MAX_SLOWDOWN = float(arg)
+        elif opt == '-m':
+            global MAX_MEMORY_GROWTH
+            MAX_MEMORY_GROWTH = float(arg)
+        elif opt == '-t':
+            global MIN_SECONDS
+            MIN_SECONDS = float(arg)
+
+if __name__ == "__main__":
+    parse_args()
+    sys.exit(0 if check() else 1)